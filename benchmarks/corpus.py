@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Deterministic synthetic comic sources for the benchmarks.
+
+    python3 benchmarks/corpus.py [--pages N] [directory]
+
+Creates (in benchmarks/corpus by default):
+    manga/      grayscale JPEG pages with panels, screentone, speech bubbles and page numbers
+    color/      color JPEG pages and double page spreads
+    webtoon/    long color PNG strips
+    manga.pdf, manga.epub, manga.cbz and manga.cb7 (only with 7z installed) made from the manga pages
+"""
+
+import argparse
+import os
+from datetime import datetime
+import shutil
+import subprocess
+import sys
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+PAGE_SIZE = (1800, 2560)
+SPREAD_SIZE = (3600, 2560)
+STRIP_SIZE = (800, 6000)
+# fixed dates keep the containers byte for byte the same between runs
+TIMESTAMP = datetime(2012, 1, 1)
+EPUB_CONTAINER = ('<?xml version="1.0"?>\n'
+                  '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles>'
+                  '<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                  '</rootfiles></container>\n')
+EPUB_PACKAGE = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<package version="3.0" unique-identifier="id" xmlns="http://www.idpf.org/2007/opf">'
+                '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:identifier id="id">kcc-benchmark'
+                '</dc:identifier><dc:title>Benchmark</dc:title><dc:language>en</dc:language></metadata>'
+                '<manifest>{items}</manifest><spine>{spine}</spine></package>\n')
+EPUB_PAGE = ('<?xml version="1.0" encoding="utf-8"?>\n'
+             '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Page</title></head>'
+             '<body><img src="{image}"/></body></html>\n')
+
+
+def panels(rng, box, rows):
+    left, top, right, bottom = box
+    edges = np.sort(rng.uniform(top, bottom, rows - 1)).astype(int).tolist()
+    for upper, lower in zip([top] + edges, edges + [bottom]):
+        columns = int(rng.integers(1, 4))
+        splits = np.sort(rng.uniform(left, right, columns - 1)).astype(int).tolist()
+        for x0, x1 in zip([left] + splits, splits + [right]):
+            if x1 - x0 > 60 and lower - upper > 60:
+                yield x0 + 12, upper + 12, x1 - 12, lower - 12
+
+
+def drawBubble(draw, rng, panel, fill=255):
+    x0, y0, x1, y1 = panel
+    width, height = int(rng.integers(120, 320)), int(rng.integers(80, 200))
+    if x1 - x0 <= width or y1 - y0 <= height:
+        return
+    x, y = int(rng.integers(x0, x1 - width)), int(rng.integers(y0, y1 - height))
+    draw.ellipse((x, y, x + width, y + height), fill=fill, outline=0, width=4)
+    for line in range(1, 4):
+        length = int(rng.integers(width // 3, width // 2))
+        ly = y + line * height // 4
+        draw.rectangle((x + width // 2 - length // 2, ly - 5, x + width // 2 + length // 2, ly + 5), fill=0)
+
+
+def mangaPage(rng, number):
+    width, height = PAGE_SIZE
+    yy, xx = np.mgrid[0:height, 0:width]
+    tone = ((xx % 8 < 3) & (yy % 8 < 3))
+    image = Image.new('L', PAGE_SIZE, 255)
+    draw = ImageDraw.Draw(image)
+    for panel in panels(rng, (90, 110, width - 90, height - 160), int(rng.integers(2, 5))):
+        draw.rectangle(panel, fill=255, outline=0, width=6)
+        if rng.random() < 0.5:
+            mask = np.zeros((height, width), dtype=bool)
+            mask[panel[1] + 6:panel[3] - 6, panel[0] + 6:panel[2] - 6] = True
+            pixels = np.array(image)
+            pixels[mask & tone] = int(rng.integers(60, 160))
+            image = Image.fromarray(pixels)
+            draw = ImageDraw.Draw(image)
+        for _ in range(int(rng.integers(5, 25))):
+            points = rng.uniform((panel[0], panel[1]), (panel[2], panel[3]), (2, 2)).astype(int)
+            draw.line([tuple(p) for p in points.tolist()], fill=0, width=int(rng.integers(2, 8)))
+        drawBubble(draw, rng, panel)
+    draw.text((width / 2, height - 70), str(number), fill=0, anchor='ms', font_size=36)
+    # scanner noise
+    pixels = np.array(image, dtype=np.int16) + rng.normal(0, 6, (height, width)).astype(np.int16)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def colorPage(rng, size):
+    width, height = size
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    pixels = np.full((height, width, 3), 255, dtype=np.float32)
+    for panel in panels(rng, (60, 60, width - 60, height - 60), int(rng.integers(2, 4))):
+        x0, y0, x1, y1 = panel
+        start, end = rng.uniform(0, 255, 3), rng.uniform(0, 255, 3)
+        ratio = ((xx[y0:y1, x0:x1] - x0) / (x1 - x0) + (yy[y0:y1, x0:x1] - y0) / (y1 - y0))[..., None] / 2
+        pixels[y0:y1, x0:x1] = start + (end - start) * ratio
+    pixels += rng.normal(0, 4, pixels.shape)
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    draw = ImageDraw.Draw(image)
+    for panel in panels(rng, (60, 60, width - 60, height - 60), 3):
+        draw.rectangle(panel, outline=(0, 0, 0), width=5)
+        drawBubble(draw, rng, panel, fill=(255, 255, 255))
+    return image
+
+
+def webtoonStrip(rng):
+    width, height = STRIP_SIZE
+    image = Image.new('RGB', STRIP_SIZE, (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    y = int(rng.integers(100, 400))
+    while y < height - 300:
+        panel_height = int(rng.integers(400, 1200))
+        panel = (40, y, width - 40, min(y + panel_height, height - 100))
+        draw.rectangle(panel, fill=tuple(rng.integers(120, 255, 3).tolist()), outline=(0, 0, 0), width=4)
+        drawBubble(draw, rng, panel, fill=(255, 255, 255))
+        # empty gap between panels, this is where the strips are split
+        y = panel[3] + int(rng.integers(150, 600))
+    return image
+
+
+def addToArchive(archive, path, arcname):
+    info = ZipInfo(arcname, TIMESTAMP.timetuple()[:6])
+    with open(path, 'rb') as f:
+        archive.writestr(info, f.read(), ZIP_STORED)
+
+
+def makeCorpora(directory, pages):
+    rng = np.random.default_rng(2012)
+    manga = os.path.join(directory, 'manga')
+    for number in range(pages):
+        chapter = os.path.join(manga, f'Chapter {number // 8 + 1:02d}')
+        os.makedirs(chapter, exist_ok=True)
+        mangaPage(rng, number + 1).save(os.path.join(chapter, f'{number + 1:03d}.jpg'), quality=85)
+    color = os.path.join(directory, 'color')
+    os.makedirs(color, exist_ok=True)
+    for number in range(pages):
+        size = SPREAD_SIZE if number % 4 == 3 else PAGE_SIZE
+        colorPage(rng, size).save(os.path.join(color, f'{number + 1:03d}.jpg'), quality=90)
+    webtoon = os.path.join(directory, 'webtoon')
+    os.makedirs(webtoon, exist_ok=True)
+    for number in range(max(1, pages // 4)):
+        webtoonStrip(rng).save(os.path.join(webtoon, f'{number + 1:03d}.png'))
+
+    files = []
+    for root, _, names in sorted(os.walk(manga)):
+        files.extend(os.path.join(root, name) for name in sorted(names))
+    images = [Image.open(path) for path in files]
+    images[0].save(os.path.join(directory, 'manga.pdf'), save_all=True, append_images=images[1:], resolution=300,
+                   creationDate=TIMESTAMP.timetuple(), modDate=TIMESTAMP.timetuple())
+    with ZipFile(os.path.join(directory, 'manga.cbz'), 'w', ZIP_STORED) as archive:
+        for path in files:
+            addToArchive(archive, path, os.path.relpath(path, manga))
+    with ZipFile(os.path.join(directory, 'manga.epub'), 'w', ZIP_DEFLATED) as archive:
+        date = TIMESTAMP.timetuple()[:6]
+        archive.writestr(ZipInfo('mimetype', date), 'application/epub+zip', ZIP_STORED)
+        archive.writestr(ZipInfo('META-INF/container.xml', date), EPUB_CONTAINER, ZIP_DEFLATED)
+        items, spine = [], []
+        for number, path in enumerate(files):
+            image = 'Images/' + os.path.relpath(path, manga).replace(os.sep, '/')
+            addToArchive(archive, path, 'OEBPS/' + image)
+            archive.writestr(ZipInfo(f'OEBPS/Text/{number:03d}.xhtml', date),
+                             EPUB_PAGE.format(image='../' + image), ZIP_DEFLATED)
+            items.append(f'<item id="page{number}" href="Text/{number:03d}.xhtml" media-type="application/xhtml+xml"/>'
+                         f'<item id="image{number}" href="{image}" media-type="image/jpeg"/>')
+            spine.append(f'<itemref idref="page{number}"/>')
+        archive.writestr(ZipInfo('OEBPS/content.opf', date),
+                         EPUB_PACKAGE.format(items=''.join(items), spine=''.join(spine)), ZIP_DEFLATED)
+    cb7 = os.path.join(directory, 'manga.cb7')
+    if shutil.which('7z'):
+        if os.path.exists(cb7):
+            os.remove(cb7)
+        subprocess.run(['7z', 'a', '-bd', cb7, '.'], cwd=manga, stdout=subprocess.DEVNULL, check=True)
+    else:
+        print('7z is missing, manga.cb7 is not created.')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', nargs='?', default=DEFAULT_DIRECTORY)
+    parser.add_argument('--pages', type=int, default=16)
+    args = parser.parse_args()
+    if os.path.exists(args.directory) and os.listdir(args.directory):
+        print(f'{args.directory} is not empty.')
+        return 1
+    makeCorpora(args.directory, args.pages)
+    print(f'Corpora created in {args.directory}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the page number detection on pathological pages.
+
+Compares group_close_values/merge_boxes with the loop based versions they replaced and
+checks that both find the same boxes.
+
+    python3 benchmarks/page_number_crop.py [--runs N]
+"""
+
+import argparse
+import os
+import sys
+from timeit import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kindlecomicconverter.common_crop import group_close_values  # noqa: E402
+from kindlecomicconverter.page_number_crop_alg import merge_boxes  # noqa: E402
+
+
+def reference_group_close_values(vals, max_dist_tolerated):
+    groups = []
+    group_start = -1
+    group_end = 0
+    for i in range(len(vals)):
+        dist = vals[i] - group_end
+        if group_start == -1:
+            group_start = vals[i]
+            group_end = vals[i]
+        elif dist <= max_dist_tolerated:
+            group_end = vals[i]
+        else:
+            groups.append((group_start, group_end))
+            group_start = -1
+            group_end = -1
+    if group_start != -1:
+        groups.append((group_start, group_end))
+    return groups
+
+
+def reference_box_intersect(box1, box2, max_dist):
+    return not (box2[0]-max_dist[0] > box1[1]
+                or box2[1]+max_dist[0] < box1[0]
+                or box2[2]-max_dist[1] > box1[3]
+                or box2[3]+max_dist[1] < box1[2])
+
+
+def reference_merge_boxes(boxes, max_dist_tolerated):
+    j = 0
+    while j < len(boxes)-1:
+        g1 = boxes[j]
+        intersecting_boxes = []
+        other_boxes = []
+        for i in range(j+1, len(boxes)):
+            g2 = boxes[i]
+            if reference_box_intersect(g1, g2, max_dist_tolerated):
+                intersecting_boxes.append(g2)
+            else:
+                other_boxes.append(g2)
+        if len(intersecting_boxes) > 0:
+            intersecting_boxes = np.array([g1, *intersecting_boxes])
+            merged_box = np.array([
+                np.min(intersecting_boxes[:, 0]),
+                np.max(intersecting_boxes[:, 1]),
+                np.min(intersecting_boxes[:, 2]),
+                np.max(intersecting_boxes[:, 3])
+            ])
+            other_boxes.append(merged_box)
+            boxes = np.concatenate([boxes[:j], other_boxes])
+            j = 0
+        else:
+            j += 1
+    return boxes
+
+
+def window(width, height, density, seed):
+    """Bottom window of a noisy scan, True where a pixel is darker than the threshold."""
+    rng = np.random.default_rng(seed)
+    mask = rng.random((height, width)) < density
+    # a few page number sized blobs
+    for x in rng.integers(0, width - 40, 3):
+        mask[height // 3:height - 1, x:x + 30] = True
+    return mask
+
+
+def boxes_of(mask, group, max_dist):
+    groups = []
+    for i in range(mask.shape[0]):
+        groups.extend((g[0], g[1], i, i) for g in group(np.where(mask[i])[0], max_dist[0]))
+    return np.array(groups)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+    # bottom window of a 2000x3000 page, see page_number_crop_alg
+    width, height = 2000, int(3000 * 0.02 * 1.25)
+    max_dist = (width * 0.01, 3000 * 0.002)
+    for density in (0.0005, 0.002, 0.01, 0.05):
+        mask = window(width, height, density, 0)
+        new_boxes = boxes_of(mask, group_close_values, max_dist)
+        old_boxes = boxes_of(mask, reference_group_close_values, max_dist)
+        assert np.array_equal(new_boxes, old_boxes)
+        new = merge_boxes(new_boxes, max_dist)
+        old = reference_merge_boxes(old_boxes, max_dist)
+        assert sorted(map(tuple, new.tolist())) == sorted(map(tuple, np.asarray(old).tolist()))
+        new_time = timeit(lambda: merge_boxes(boxes_of(mask, group_close_values, max_dist), max_dist),
+                          number=args.runs) / args.runs
+        old_time = timeit(lambda: reference_merge_boxes(boxes_of(mask, reference_group_close_values, max_dist),
+                                                        max_dist), number=args.runs) / args.runs
+        print(f'density {density}: {len(new_boxes)} runs, {len(new)} boxes, '
+              f'{old_time * 1000:.1f} ms -> {new_time * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
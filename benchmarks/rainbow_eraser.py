@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the rainbow artifacts eraser on device sized pages.
+
+Compares erase_rainbow_artifacts with the original full page transform: time, peak numpy
+memory, difference of the results and the attenuation of diagonal stripes. Pages larger
+than FULL_FRAME_PIXELS (like the default size) are filtered in tiles.
+Then times every installed FFT backend with one and with --threads threads.
+
+    python3 benchmarks/rainbow_eraser.py [--size 1860x2480] [--runs N] [--threads N]
+"""
+
+import argparse
+import os
+import sys
+import tracemalloc
+from timeit import timeit
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kindlecomicconverter import rainbow_artifacts_eraser  # noqa: E402
+from kindlecomicconverter.rainbow_artifacts_eraser import attenuate_diagonal_frequencies, \
+    erase_rainbow_artifacts  # noqa: E402
+
+
+def reference_erase_rainbow_artifacts(img, is_color):
+    if is_color:
+        rgb_to_yuv = np.array([[0.299, 0.587, 0.114], [-0.14713, -0.28886, 0.436], [0.615, -0.51499, -0.10001]])
+        yuv_to_rgb = np.array([[1.0, 0.0, 1.13983], [1.0, -0.39465, -0.58060], [1.0, 2.03211, 0.0]])
+        yuv = np.array(img, dtype=np.float32) @ rgb_to_yuv.T
+        spectrum = attenuate_diagonal_frequencies(np.fft.rfft2(yuv[:, :, 0].astype(np.float32)))
+        yuv[:, :, 0] = np.clip(np.fft.irfft2(spectrum, s=yuv.shape[:2]), 0, 255)
+        return Image.fromarray(np.clip(yuv @ yuv_to_rgb.T, 0, 255).astype(np.uint8), mode='RGB')
+    spectrum = attenuate_diagonal_frequencies(np.fft.rfft2(np.asarray(img, dtype=np.float32)))
+    return Image.fromarray(np.clip(np.fft.irfft2(spectrum, s=img.size[::-1]), 0, 255).astype(np.uint8), mode='L')
+
+
+def page(width, height, is_color, seed):
+    """Noisy panels with screentone, the kind of page the eraser is used for."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    pixels = np.full((height, width), 230.0)
+    for _ in range(6):
+        x0, y0 = rng.integers(0, width // 2), rng.integers(0, height // 2)
+        x1, y1 = x0 + rng.integers(100, width // 2), y0 + rng.integers(100, height // 2)
+        period = rng.integers(3, 8)
+        pixels[y0:y1, x0:x1] = np.where((xx[y0:y1, x0:x1] + yy[y0:y1, x0:x1]) % period < 2, 40, 200)
+    pixels += rng.normal(0, 8, pixels.shape)
+    if is_color:
+        pixels = pixels[..., None] * rng.uniform(0.5, 1, 3)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def stripes(width, height, frequency, angle):
+    yy, xx = np.mgrid[0:height, 0:width]
+    angle = np.deg2rad(angle)
+    pixels = 128 + 60 * np.sin(2 * np.pi * frequency * (xx * np.cos(angle) - yy * np.sin(angle)))
+    return Image.fromarray(pixels.astype(np.uint8))
+
+
+def peak_memory(function, *args):
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', default='1860x2480')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    width, height = map(int, args.size.split('x'))
+    for is_color in (False, True):
+        img = page(width, height, is_color, 0)
+        new, old = erase_rainbow_artifacts(img, is_color), reference_erase_rainbow_artifacts(img, is_color)
+        diff = np.abs(np.asarray(new, dtype=np.int16) - np.asarray(old, dtype=np.int16))
+        new_time = timeit(lambda: erase_rainbow_artifacts(img, is_color), number=args.runs) / args.runs
+        old_time = timeit(lambda: reference_erase_rainbow_artifacts(img, is_color), number=args.runs) / args.runs
+        print(f'{"color" if is_color else "grayscale"} {width}x{height}: '
+              f'{old_time * 1000:.0f} ms -> {new_time * 1000:.0f} ms, '
+              f'{peak_memory(reference_erase_rainbow_artifacts, img, is_color) / 2**20:.0f} MB -> '
+              f'{peak_memory(erase_rainbow_artifacts, img, is_color) / 2**20:.0f} MB, '
+              f'difference mean {diff.mean():.3f} max {diff.max()}')
+    # the filtered angles keep a tenth of the stripes, the others all of them
+    for frequency, angle in ((0.35, 135), (0.4, 45), (0.35, 120), (0.2, 135)):
+        img = stripes(1000, 1400, frequency, angle)
+        before = np.asarray(img, dtype=np.float32).std()
+        old = np.asarray(reference_erase_rainbow_artifacts(img, False), dtype=np.float32).std()
+        new = np.asarray(erase_rainbow_artifacts(img, False), dtype=np.float32).std()
+        print(f'stripes {frequency} cycles/pixel at {angle}°: amplitude kept {old / before:.1%} -> {new / before:.1%}')
+
+    backends = [rainbow_artifacts_eraser.NumpyFFT()]
+    if rainbow_artifacts_eraser.scipy:
+        backends.append(rainbow_artifacts_eraser.ScipyFFT())
+    if rainbow_artifacts_eraser.pyfftw:
+        backends.append(rainbow_artifacts_eraser.fft_backend)
+    img = page(width, height, True, 0)
+    default = np.asarray(erase_rainbow_artifacts(img, True), dtype=np.int16)
+    for backend in backends:
+        rainbow_artifacts_eraser.fft_backend = backend
+        for threads in sorted({1, args.threads}):
+            rainbow_artifacts_eraser.set_fft_threads(threads)
+            diff = np.abs(np.asarray(erase_rainbow_artifacts(img, True), dtype=np.int16) - default).max()
+            seconds = timeit(lambda: erase_rainbow_artifacts(img, True), number=args.runs) / args.runs
+            print(f'{backend.name} with {threads} threads: {seconds * 1000:.0f} ms, difference max {diff}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Converts the synthetic corpora (see corpus.py) with several profile and option sets.
+
+    python3 benchmarks/corpus.py
+    python3 benchmarks/run.py [--corpus DIR] [--output results.json] [--compare old.json] [--case TEXT]
+
+Every case runs in a fresh process, so the peak RSS belongs to that conversion alone. It is
+reported for the main process and for the largest worker. Pages per second count source pages,
+stage times come from --profile-report and are summed over all workers.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from multiprocessing import cpu_count, set_start_method
+from shutil import rmtree
+from time import perf_counter
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.corpus import DEFAULT_DIRECTORY  # noqa: E402
+
+SOURCES = {
+    'manga': 'manga',
+    'color': 'color',
+    'webtoon': 'webtoon',
+    'pdf': 'manga.pdf',
+    'epub': 'manga.epub',
+    'cbz': 'manga.cbz',
+    'cb7': 'manga.cb7',
+}
+# (source, profile, options)
+MATRIX = [
+    ('manga', 'KPW5', ['-f', 'CBZ']),
+    ('manga', 'KPW5', ['-f', 'EPUB', '--cropping', '2', '--interpanelcrop', '2']),
+    ('manga', 'KS', ['-f', 'PDF', '--forcepng']),
+    ('manga', 'KPW5,KS,KoL', ['-f', 'CBZ']),
+    ('manga', 'KPW5', ['-f', 'CBZ', '--inmemory']),
+    ('color', 'KCS', ['-f', 'CBZ', '--forcecolor', '-r', '2']),
+    ('color', 'KCS', ['-f', 'EPUB', '--forcecolor', '--eraserainbow']),
+    ('webtoon', 'KPW5', ['-f', 'CBZ', '-w']),
+    ('pdf', 'KPW5', ['-f', 'CBZ']),
+    ('pdf', 'KPW5', ['-f', 'CBZ', '--inmemory']),
+    ('pdf', 'KCS', ['-f', 'CBZ', '--inmemory', '--forcecolor', '--eraserainbow']),
+    ('epub', 'KPW5', ['-f', 'CBZ']),
+    ('cbz', 'KPW5', ['-f', 'EPUB']),
+    ('cb7', 'KPW5', ['-f', 'CBZ']),
+]
+
+
+def caseName(case):
+    source, profile, options = case
+    return ' '.join([source, profile] + options)
+
+
+def peakRSS(who):
+    if resource is None:
+        return 0
+    rss = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def directorySize(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def runCase(case, corpus):
+    """Body of the benchmark process, the result is printed as JSON."""
+    from kindlecomicconverter import comic2ebook
+    from kindlecomicconverter.shared import resetWorkerPool
+
+    source, profile, options = case
+    path = os.path.join(corpus, SOURCES[source])
+    if not os.path.exists(path):
+        return {'status': 'skipped', 'reason': f'{path} is missing'}
+    # not KCC-*, checkPre removes those
+    output = tempfile.mkdtemp('', 'benchmark-')
+    report = os.path.join(tempfile.mkdtemp('', 'benchmark-'), 'profile.json')
+    try:
+        start = perf_counter()
+        # the conversion log would mix with the result
+        with redirect_stdout(sys.stderr):
+            status = comic2ebook.main(['-p', profile] + options + ['-o', output, '--profile-report', report, path])
+        seconds = perf_counter() - start
+        resetWorkerPool()
+        if status:
+            return {'status': 'failed', 'reason': f'exit status {status}'}
+        with open(report, encoding='utf-8') as f:
+            books = json.load(f)['books']
+        pages = sum(book['pages'] for book in books)
+        return {
+            'status': 'ok',
+            'seconds': seconds,
+            'pages': pages,
+            'pages_per_second': pages / seconds,
+            'peak_rss_mb': {'main': peakRSS(resource and resource.RUSAGE_SELF),
+                            'workers': peakRSS(resource and resource.RUSAGE_CHILDREN)},
+            'output_bytes': directorySize(output),
+            'stages': {stage: timing['seconds'] for book in books for stage, timing in book['stages'].items()},
+        }
+    except BaseException as err:
+        return {'status': 'failed', 'reason': f'{type(err).__name__}: {err}'}
+    finally:
+        rmtree(output, True)
+        rmtree(os.path.dirname(report), True)
+
+
+def compare(results, previous):
+    old = {case['name']: case for case in previous['cases']}
+    print(f'{"case":60} {"pages/s":>16} {"peak RSS MB":>16} {"output":>16}')
+    for case in results['cases']:
+        before = old.get(case['name'])
+        if case['status'] != 'ok' or not before or before['status'] != 'ok':
+            print(f'{case["name"]:60} {case["status"]:>16}')
+            continue
+        rss, rss_before = sum(case['peak_rss_mb'].values()), sum(before['peak_rss_mb'].values())
+        print(f'{case["name"]:60} '
+              f'{case["pages_per_second"] / before["pages_per_second"] - 1:>+16.1%} '
+              f'{rss / rss_before - 1 if rss_before else 0:>+16.1%} '
+              f'{case["output_bytes"] / before["output_bytes"] - 1:>+16.1%}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus', default=DEFAULT_DIRECTORY)
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', help='Earlier results file')
+    parser.add_argument('--case', help='Run only the cases with this text in their name')
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        set_start_method('spawn')
+        print(json.dumps(runCase(MATRIX[args.run], args.corpus)))
+        return 0
+
+    if not os.path.isdir(args.corpus):
+        print(f'{args.corpus} is missing, create it with benchmarks/corpus.py first.')
+        return 1
+    from kindlecomicconverter import __version__
+    results = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': cpu_count(),
+        'cases': [],
+    }
+    for index, case in enumerate(MATRIX):
+        name = caseName(case)
+        if args.case and args.case not in name:
+            continue
+        print(f'{name}...', flush=True)
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--corpus', args.corpus, '--run', str(index)],
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            result = json.loads(process.stdout.splitlines()[-1])
+        except (IndexError, ValueError):
+            result = {'status': 'failed', 'reason': f'benchmark process exit status {process.returncode}'}
+        if result['status'] == 'ok':
+            print(f'    {result["pages_per_second"]:.2f} pages/s, {result["peak_rss_mb"]["main"]:.0f} + '
+                  f'{result["peak_rss_mb"]["workers"]:.0f} MB, {result["output_bytes"]} bytes')
+        else:
+            print(f'    {result["status"]}: {result["reason"]}')
+        results['cases'].append({'name': name, 'source': case[0], 'profile': case[1], 'options': case[2], **result})
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results saved to {args.output}')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(results, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
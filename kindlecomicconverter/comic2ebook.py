@@ -18,7 +18,8 @@
 # PERFORMANCE OF THIS SOFTWARE.
 #
 
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
 import json
 import os
@@ -34,10 +35,11 @@ from glob import glob, escape
 from re import sub
 from stat import S_IWRITE, S_IREAD, S_IEXEC
 from typing import List
-from zipfile import ZipFile, ZIP_STORED
 from tempfile import mkdtemp, gettempdir
 from shutil import move, copytree, rmtree
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from threading import Lock
 from uuid import uuid4
 from natsort import os_sort_keygen, os_sorted
 from slugify import slugify as slugify_ext
@@ -46,10 +48,17 @@ from pathlib import Path
 from subprocess import STDOUT, PIPE, CalledProcessError
 from psutil import virtual_memory, disk_usage
 from html import escape as hescape
+from io import BytesIO
+import numpy as np
 import pymupdf
 
-from .shared import IMAGE_TYPES, getImageFileName, walkSort, walkLevel, sanitizeTrace, subprocess_run, dot_clean, get_contain_resolution
-from .comicarchive import SEVENZIP, available_archive_tools
+from .shared import IMAGE_TYPES, getImageFileName, walkSort, walkLevel, sanitizeTrace, subprocess_run, dot_clean, get_contain_resolution, \
+    getWorkerPool, resetWorkerPool, getChunkSize, stageTimings, stageTimer, MemoryBudget
+from .comicarchive import SEVENZIP, EXCLUDED_MEMBERS, available_archive_tools
+from .pagestore import PageRecord, PageStore
+from .zipsink import ZipSink
+from .pagecache import PageCache
+from .rainbow_artifacts_eraser import set_fft_threads
 from . import comic2panel
 from . import image
 from . import comicarchive
@@ -61,6 +70,21 @@ from . import __version__
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 OS_SORT_KEY = os_sort_keygen()
+pageStore = PageStore()
+pageSink = None
+# PDF of the streamed pages open in this process
+pdf_document = None
+tickLock = Lock()
+# sizes of the source images that were streamed into the workers
+sourceSizes = []
+jobCount = 1
+pageStats = {}
+profileReport = []
+# peak memory of a worker per source pixel, measured with the default processing
+PAGE_MEMORY = {'L': 12, '1': 12}
+PAGE_MEMORY_COLOR = 20
+# pages buildPDF reads ahead of the one it inserts
+PDF_PREFETCH = 8
 
 def main(argv=None):
     global options
@@ -82,6 +106,8 @@ def main(argv=None):
         fusion_path = makeFusion(list(sources))
         sources.clear()
         sources.append(fusion_path)
+    if options.jobs > 1 and len(sources) > 1:
+        return makeBooks(sources, args)
     for source in sources:
         source = source.rstrip('\\').rstrip('/')
         options = copy(args)
@@ -90,19 +116,118 @@ def main(argv=None):
         options = checkOptions(options)
         print('Working on ' + source + '...')
         makeBook(source)
+    if args.profilereport:
+        writeProfileReport(args.profilereport)
 
     return 0
 
 
+def makeBooks(sources, args):
+    """Convert several books at the same time, every job runs its own share of worker processes.
+
+    The jobs split one total of workers (--workers or one per CPU) evenly, there are never
+    more jobs than workers.
+    """
+    total = args.workers or cpu_count()
+    jobs = min(args.jobs, len(sources), total)
+    workers = max(1, total // jobs)
+    suffixes = reserveOutputNames(sources, args)
+    checkPre()
+    checkPre('LLL-')
+    executor = ProcessPoolExecutor(jobs)
+    try:
+        futures = []
+        for number, source in enumerate(sources, 1):
+            job_progress = f'[{number}/{len(sources)}] '
+            futures.append(executor.submit(makeBookJob, source.rstrip('\\').rstrip('/'), args, jobs, workers, job_progress,
+                                           suffixes[number - 1]))
+        for future in as_completed(futures):
+            future.result()
+        for future in futures:
+            profileReport.extend(future.result())
+    finally:
+        executor.shutdown(cancel_futures=True)
+    if args.profilereport:
+        writeProfileReport(args.profilereport)
+    return 0
+
+
+def reserveOutputNames(sources, args):
+    """Output suffix of every book of a parallel conversion.
+
+    The jobs pick the names of their files on their own and only create them once the book
+    is done, so books that would get the same name are told apart before any job starts.
+    """
+    global options
+    options = checkOptions(copy(args))
+    ext = {'CBZ': '.cbz', 'PDF': '.pdf'}.get(options.format, '.epub')
+    reserved = set()
+    suffixes = []
+    for source in sources:
+        source = source.rstrip('\\').rstrip('/')
+        counter = 0
+        options.outputsuffix = ''
+        filename = getOutputFilename(source, options.output, ext, '')
+        while filename in reserved:
+            options.outputsuffix = '_kcc' + str(counter)
+            counter += 1
+            filename = getOutputFilename(source, options.output, ext, '')
+        reserved.add(filename)
+        suffixes.append(options.outputsuffix)
+    return suffixes
+
+
+def makeBookJob(source, args, jobs, workers, job_progress, suffix=''):
+    global options, jobCount
+    jobCount = jobs
+    options = checkOptions(copy(args))
+    options.workers = workers
+    options.outputsuffix = suffix
+    profileReport.clear()
+    print(f'{job_progress}Working on {source}...')
+    makeBook(source, job_progress=job_progress)
+    return profileReport
+
+
+def writeProfileReport(filename):
+    # stage times are summed over all workers, processing_seconds is the wall time of the image stage
+    stages = {}
+    for book in profileReport:
+        for stage, timing in book['stages'].items():
+            seconds, calls = stages.get(stage, (0.0, 0))
+            stages[stage] = (seconds + timing['seconds'], calls + timing['calls'])
+    report = {
+        'version': __version__,
+        'books': profileReport,
+        'stages': {stage: {'seconds': seconds, 'calls': calls} for stage, (seconds, calls) in sorted(stages.items())},
+    }
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f'Profile report saved to {filename}')
+
+
+def getImageSize(filepath):
+    # the workers and the source checks recorded most images, the others are opened
+    record = pageStore.getrecord(filepath)
+    if record:
+        return record.size
+    with Image.open(pageStore.open(filepath)) as img:
+        return img.size
+
+
 def buildHTML(path, imgfile, imgfilepath, imgfile2=None):
-    key = pathlib.Path(imgfilepath).name
+    record = pageStore.getrecord(imgfilepath)
+    if record is None and not options.noprocessing:
+        # the flags of the page (rotation, background) were lost on the way, the page would come out wrong
+        raise RuntimeError('Processed page %s is not tracked.' % imgfilepath)
+    flags = record.flags if record else []
     filename = getImageFileName(imgfile)
     deviceres = options.profileData[1]
-    if not options.noprocessing and "Rotated" in options.imgMetadata[key]:
+    if not options.noprocessing and "Rotated" in flags:
         rotatedPage = True
     else:
         rotatedPage = False
-    if not options.noprocessing and "BlackBackground" in options.imgMetadata[key]:
+    if not options.noprocessing and "BlackBackground" in flags:
         additionalStyle = 'background-color:#000000;'
     else:
         additionalStyle = ''
@@ -119,11 +244,11 @@ def buildHTML(path, imgfile, imgfilepath, imgfile2=None):
     if not os.path.exists(htmlpath):
         os.makedirs(htmlpath)
     htmlfile = os.path.join(htmlpath, filename[0] + '.xhtml')
-    imgsize = Image.open(os.path.join(head, "Images", postfix, imgfile)).size
+    imgsize = getImageSize(os.path.join(head, "Images", postfix, imgfile))
     imgsizeframe = list(imgsize)
     imgsize2 = (0, 0)
     if imgfile2:
-        imgsize2 = Image.open(os.path.join(head, "Images", postfix, imgfile2)).size
+        imgsize2 = getImageSize(os.path.join(head, "Images", postfix, imgfile2))
     imgsizeframe[1] += imgsize2[1]
     if options.hq:
         imgsizeframe = (int(imgsizeframe[0] // 1.5), int(imgsizeframe[1] // 1.5))
@@ -595,7 +720,7 @@ def buildEPUB(path, chapternames, tomenumber, ischunked, cover: image.Cover, ori
         cover.save_to_folder(os.path.join(path, 'OEBPS', 'Images', 'cover.jpg'), tomenumber, len_tomes)
     dot_clean(path)
     options.covers.append((cover, options.uuid))
-    for dirpath, dirnames, filenames in os.walk(os.path.join(path, 'OEBPS', 'Images')):
+    for dirpath, dirnames, filenames in pageStore.walk(os.path.join(path, 'OEBPS', 'Images')):
         chapter = False
         dirnames, filenames = walkSort(dirnames, filenames)
         for afile in filenames:
@@ -648,186 +773,413 @@ def buildEPUB(path, chapternames, tomenumber, ischunked, cover: image.Cover, ori
     buildOPF(path, options.title, filelist, originalpath, cover)
 
 
+def prefetchPages(paths):
+    # the pages on disk are read by threads while the previous ones are inserted
+    with ThreadPoolExecutor(2) as pool:
+        pending = deque()
+        for filepath in paths:
+            pending.append((filepath, pool.submit(pageStore.get, filepath)))
+            if len(pending) > PDF_PREFETCH:
+                filepath, data = pending.popleft()
+                yield filepath, data.result()
+        while pending:
+            filepath, data = pending.popleft()
+            yield filepath, data.result()
+
+
 def buildPDF(path, title, job_progress='', cover=None, output_file=None):
     """
     Build a PDF file from processed comic images.
     Images are combined into a single PDF optimized for e-readers.
+    JPEG pages are embedded as they are, without decoding them again.
     """
     start = perf_counter()
+    paths = []
+    for root, dirs, files in pageStore.walk(os.path.join(path, "OEBPS", "Images")):
+        files.sort(key=OS_SORT_KEY)
+        dirs.sort(key=OS_SORT_KEY)
+        paths.extend(os.path.join(root, file) for file in files)
     # open empty PDF
     with pymupdf.open() as doc:
         doc.set_metadata({'title': title, 'author': options.authors[0]})
         # Stream images to PDF
-        for root, dirs, files in os.walk(os.path.join(path, "OEBPS", "Images")):
-            files.sort(key=OS_SORT_KEY)
-            dirs.sort(key=OS_SORT_KEY)
-            for file in files:
-                w, h = Image.open(os.path.join(root, file)).size
-                page = doc.new_page(width=w, height=h)
-                page.insert_image(page.rect, filename=os.path.join(root, file))
+        for filepath, data in prefetchPages(paths):
+            # the size is known from the image processing, except for covers and unprocessed pages
+            record = pageStore.getrecord(filepath)
+            w, h = record.size if record else Image.open(BytesIO(data)).size
+            page = doc.new_page(width=w, height=h)
+            page.insert_image(page.rect, stream=data)
 
         # determine output filename if not provided
         if output_file is None:
             output_file = getOutputFilename(path, None, '.pdf', '')
-        
-        # Save with optimizations for smaller file size
-        doc.save(output_file, deflate=True, garbage=4, clean=True)
+
+        if options.fastpdf:
+            # a new document has no unused objects, garbage collection would only merge duplicate images
+            # and its comparisons grow with the square of the page count
+            doc.save(output_file, deflate=True)
+        else:
+            # Save with optimizations for smaller file size
+            doc.save(output_file, deflate=True, garbage=4, clean=True)
     end = perf_counter()
     print(f"{job_progress}MuPDF output: {end-start} sec")
     return output_file
 
 
-def imgDirectoryProcessing(path, job_progress=''):
-    global workerPool, workerOutput
-    workerPool = Pool(maxtasksperchild=100)
+def imgDirectoryProcessing(path, job_progress='', work=None, pagenumber=0):
+    global workerOutput, sourceSizes
     workerOutput = []
-    options.imgMetadata = {}
-    work = []
-    pagenumber = 0
-    for dirpath, _, filenames in os.walk(path):
-        for afile in filenames:
-            pagenumber += 1
-            work.append([afile, dirpath, options])
+    sourceSizes = []
+    if work is None:
+        work = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames, filenames = walkSort(dirnames, filenames)
+            for afile in filenames:
+                work.append([afile, dirpath, options])
+        pagenumber = len(work)
     if GUI:
         GUI.progressBarTick.emit(str(pagenumber))
-    if len(work) > 0:
+    pageStats.clear()
+    pageStats.update(pages=pagenumber, cache_hits=0, stages={})
+    if pagenumber > 0:
         img_processing_start = perf_counter()
-        for i in work:
-            workerPool.apply_async(func=imgFileProcessing, args=(i,), callback=imgFileProcessingTick)
-        workerPool.close()
-        workerPool.join()
+        pageCache = None
+        if options.cachedir and not options.targets:
+            pageCache = PageCache(options.cachedir, options.cachesize * 1024 * 1024)
+        workerPool = getWorkerPool(options.workers)
+        tasks = imgFileProcessingTasks(work, pagenumber, pageCache, options.workers or cpu_count())
+        budget = None
+        if options.maxmemory:
+            budget = MemoryBudget(options.maxmemory * 1024 * 1024 // jobCount)
+            tasks = budget.admit(tasks, imgFileMemory)
+        try:
+            for index, output, timings, size in workerPool.imap_unordered(imgFileProcessingTask, tasks,
+                                                                          1 if budget else getChunkSize(pagenumber)):
+                if budget:
+                    budget.release(index)
+                if size:
+                    sourceSizes.append(size)
+                imgFileProcessingTick(output, index)
+                for stage, (seconds, calls) in timings.items():
+                    total = pageStats['stages'].setdefault(stage, {'seconds': 0.0, 'calls': 0})
+                    total['seconds'] += seconds
+                    total['calls'] += calls
+                if len(workerOutput) > 0 or (GUI and not GUI.conversionAlive):
+                    break
+        except Exception as err:
+            workerOutput.append((str(err), sanitizeTrace(err.__traceback__)))
+        finally:
+            if budget:
+                budget.close()
+        if len(workerOutput) > 0 or (GUI and not GUI.conversionAlive):
+            resetWorkerPool()
+        if pageCache:
+            pageCache.trim()
         img_processing_end = perf_counter()
+        pageStats['processing_seconds'] = img_processing_end - img_processing_start
         print(f"{job_progress}imgFileProcessing: {img_processing_end - img_processing_start} seconds")
 
         # macOS 15 likes to add ._ files after multiprocessing
         dot_clean(path)
 
         if GUI and not GUI.conversionAlive:
-            rmtree(os.path.join(path, '..', '..'), True)
+            removeWorkFolders(path)
+            pageStore.clear()
             raise UserWarning("Conversion interrupted.")
         if len(workerOutput) > 0:
-            rmtree(os.path.join(path, '..', '..'), True)
+            removeWorkFolders(path)
+            pageStore.clear()
             raise RuntimeError("One of workers crashed. Maybe restart PC. Cause: " + workerOutput[0][0], workerOutput[0][1])
     else:
-        rmtree(os.path.join(path, '..', '..'), True)
+        removeWorkFolders(path)
         raise UserWarning("C2E: Source directory is empty.")
 
 
-def imgFileProcessingTick(output):
+def imgFileProcessingTasks(work, pagenumber, pageCache=None, processes=1):
+    # consumed by the task thread of the pool, cache hits are settled here and never reach a worker
+    if pageCache:
+        settings = PageCache.settings(options)
+    for index, i in enumerate(work):
+        # PDF pages are only rendered by the worker, there are no bytes for the key
+        if pageCache and not (len(i) > 3 and isinstance(i[3], PdfPage)):
+            if len(i) < 4:
+                with open(os.path.join(i[1], i[0]), 'rb') as f:
+                    i.append(f.read())
+            key = PageCache.key(settings, i[3])
+            pages = pageCache.get(key)
+            if pages is not None:
+                imgFileProcessingTick(restoreCachedPages(i, pages), index)
+                pageStats['cache_hits'] += 1
+                continue
+            i.append(key)
+        # the last pages of a book leave workers idle, the rainbow eraser of a page can use their cores
+        threads = max(1, processes // max(1, pagenumber - index)) if options.eraserainbow else 1
+        yield index, i, threads
+
+
+def imgFileMemory(work):
+    # only the header is read, broken files are left to the worker
+    if len(work) > 3 and isinstance(work[3], PdfPage):
+        # rendered pages are about the size of the target
+        return int(work[3].target_width * work[3].target_height) * PAGE_MEMORY_COLOR
+    try:
+        with Image.open(BytesIO(work[3]) if len(work) > 3 else os.path.join(work[1], work[0])) as im:
+            return im.width * im.height * PAGE_MEMORY.get(im.mode, PAGE_MEMORY_COLOR)
+    except Exception:
+        return 0
+
+
+def imgFileProcessingTick(output, index=None):
+    # cache hits come from the task thread of the pool, worker results from the main thread
+    with tickLock:
+        imgFileProcessingResult(output, index)
+
+
+def imgFileProcessingResult(output, index):
     if isinstance(output, tuple):
         workerOutput.append(output)
-        workerPool.terminate()
     else:
+        pages = []
         for page in output:
             if page is not None:
-                options.imgMetadata[page[0]] = page[1]
+                for data, record in page[2]:
+                    if data is not None:
+                        pageStore.put(record.path, data)
+                    pageStore.setrecord(record)
+                    pages.append(record.path)
+        if pageSink:
+            pageSink.done(index, pages)
     if GUI:
         GUI.progressBarTick.emit('tick')
-        if not GUI.conversionAlive:
-            workerPool.terminate()
 
 
-def imgFileProcessing(work):
+def imgFileProcessingTask(task):
+    # stage timings and source size of this page only, a chunk of results is sent back together
+    stageTimings.clear()
+    set_fft_threads(task[2])
+    source = {}
+    output = imgFileProcessing(task[1], source)
+    return task[0], output, dict(stageTimings), source.get('size')
+
+
+def imgFileProcessing(work, source=None):
     try:
         afile = work[0]
         dirpath = work[1]
         opt = work[2]
+        data = work[3] if len(work) > 3 else None
+        if isinstance(data, PdfPage):
+            with stageTimer('pdf'):
+                data = load_pdf_page(data)
         output = []
-        workImg = image.ComicPageParser((dirpath, afile), opt)
-        for i in workImg.payload:
-            img = image.ComicPage(opt, *i)
-            if opt.cropping == 2 and not opt.webtoon:
-                img.cropPageNumber(opt.croppingp, opt.croppingm)
-            if opt.cropping == 1 and not opt.webtoon:
-                img.cropMargin(opt.croppingp, opt.croppingm)
-            if opt.interpanelcrop > 0:
-                img.cropInterPanelEmptySections("horizontal" if opt.interpanelcrop == 1 else "both")
-
-            img.gammaCorrectImage()
-
-            if not img.colorOutput:
-                img.convertToGrayscale()
-
-            img.autocontrastImage()
-            img.resizeImage()
-            img.optimizeForDisplay(opt.eraserainbow, img.colorOutput)
-
-            if img.colorOutput:
-                pass
-            elif opt.forcepng:
-                if not opt.noquantize:
-                    img.quantizeImage()
-                if opt.format == 'PDF':
-                    img.convertToGrayscale()
-                elif opt.profile == 'KDX' and opt.format == 'CBZ':
-                    img.convertToGrayscale()
-                elif opt.pnglegacy:
-                    img.convertToGrayscale()
-            output.append(img.saveToDir())
+        try:
+            workImg = image.ComicPageParser((dirpath, afile), opt, data)
+        except Exception as err:
+            if data is None:
+                raise
+            # streamed pages skip detectSuboptimalProcessing, they are only opened here
+            name = os.path.join(dirpath, afile).split('OEBPS' + os.path.sep + 'Images')[-1]
+            raise RuntimeError('Image file %s is corrupted. Error: %s' % (name, str(err)))
+        if source is not None:
+            source['size'] = workImg.sourceSize
+        if opt.targets:
+            # profiles that split the page the same way share everything up to the gamma correction
+            payloads = {}
+            for target in opt.targets:
+                payload = workImg.payload if target is opt.targets[0] else workImg.splitFor(target)
+                payloads.setdefault(tuple(i[0] for i in payload), (payload, []))[1].append(target)
+            for payload, targets in payloads.values():
+                for i in payload:
+                    img = imgPageCropping(image.ComicPage(opt, *i), opt)
+                    for target in targets:
+                        targetdir = os.path.join(target.workdir, 'OEBPS', 'Images',
+                                                 os.path.relpath(dirpath, os.path.join(opt.workdir, 'OEBPS', 'Images')))
+                        output.append(imgPageProcessing(img.retarget(target, targetdir), target))
+        else:
+            for i in workImg.payload:
+                img = imgPageCropping(image.ComicPage(opt, *i), opt)
+                output.append(imgPageProcessing(img, opt))
+        if len(work) > 4:
+            storeCachedPages(work, output)
         return output
     except Exception:
         return str(sys.exc_info()[1]), sanitizeTrace(sys.exc_info()[2])
 
 
-def render_page(vector):
-    """Render a page range of a document.
+def imgPageCropping(img, opt):
+    if opt.cropping == 2 and not opt.webtoon:
+        img.cropPageNumber(opt.croppingp, opt.croppingm)
+    if opt.cropping == 1 and not opt.webtoon:
+        img.cropMargin(opt.croppingp, opt.croppingm)
+    if opt.interpanelcrop > 0:
+        img.cropInterPanelEmptySections("horizontal" if opt.interpanelcrop == 1 else "both")
+    return img
+
+
+def imgPageProcessing(img, opt):
+    img.gammaCorrectImage()
+
+    if not img.colorOutput:
+        img.convertToGrayscale()
+
+    img.autocontrastImage()
+    img.resizeImage()
+    img.optimizeForDisplay(opt.eraserainbow, img.colorOutput)
+
+    if img.colorOutput:
+        pass
+    elif opt.forcepng:
+        if not opt.noquantize:
+            img.quantizeImage()
+        if opt.format == 'PDF':
+            img.convertToGrayscale()
+        elif opt.profile == 'KDX' and opt.format == 'CBZ':
+            img.convertToGrayscale()
+        elif opt.pnglegacy:
+            img.convertToGrayscale()
+    return img.saveToDir()
+
+
+def storeCachedPages(work, output):
+    # names are kept relative to the source file, the same image can be on another position next time
+    stem = os.path.splitext(work[0])[0]
+    pages = []
+    for name, flags, files in output:
+        pages.append([name[len(stem):], flags, [(os.path.basename(record.path)[len(stem):], data, record.size,
+                                                 record.color, record.codec) for data, record in files]])
+    PageCache(work[2].cachedir).put(work[4], pages)
+
+
+def restoreCachedPages(work, pages):
+    afile, dirpath = work[0], work[1]
+    stem = os.path.splitext(afile)[0]
+    output = []
+    for name, flags, files in pages:
+        output.append([stem + name, flags, [(data, PageRecord(os.path.join(dirpath, stem + suffix), size, flags, color, codec))
+                                            for suffix, data, size, color, codec in files]])
+    if os.path.isfile(os.path.join(dirpath, afile)):
+        os.remove(os.path.join(dirpath, afile))
+    return output
 
-    Notes:
-        The PyMuPDF document cannot be part of the argument, because that
-        cannot be pickled. So we are being passed in just its filename.
-        This is no performance issue, because we are a separate process and
-        need to open the document anyway.
-        Any page-specific function can be processed here - rendering is just
-        an example - text extraction might be another.
-        The work must however be self-contained: no inter-process communication
-        or synchronization is possible with this design.
-        Care must also be taken with which parameters are contained in the
-        argument, because it will be passed in via pickling by the Pool class.
-        So any large objects will increase the overall duration.
-    Args:
-        vector: a list containing required parameters.
+
+def pdf_page_batches(num_pages, cpu):
+    """Page ranges of the workers, large at first and single pages at the end.
+
+    The workers take the next range when they are done with theirs, so a slow page
+    (dense vector art, a huge scan) only holds up its own worker.
     """
-    # recreate the arguments
-    idx = vector[0]  # this is the segment number we have to process
-    cpu = vector[1]  # number of CPUs
-    filename = vector[2]  # document filename
-    output_dir = vector[3]
-    target_width = vector[4]
-    target_height = vector[5]
-    pdf_width = vector[6]
-    with pymupdf.open(filename) as doc:  # open the document
-        num_pages = doc.page_count  # get number of pages
-
-        # pages per segment: make sure that cpu * seg_size >= num_pages!
-        seg_size = int(num_pages / cpu + 1)
-        seg_from = idx * seg_size  # our first page number
-        seg_to = min(seg_from + seg_size, num_pages)  # last page number
-
-        for i in range(seg_from, seg_to):  # work through our page segment
-            page = doc[i]
-            if not pdf_width or page.rect.width > page.rect.height:
-                zoom = target_height / page.rect.height
-            else:
-                zoom = target_width / page.rect.width
-            mat = pymupdf.Matrix(zoom, zoom)
-            # TODO: decide colorspace earlier so later color check is cheaper.
-            # This is actually pretty hard when you have to deal with color vector text
-            pix = page.get_pixmap(matrix=mat, colorspace='RGB', alpha=False)
-            pix.save(os.path.join(output_dir, "p-%i.png" % i))
-        print("Processed page numbers %i through %i" % (seg_from, seg_to - 1))
+    seg_from = 0
+    while seg_from < num_pages:
+        seg_size = max(1, (num_pages - seg_from) // (cpu * 4))
+        yield seg_from, min(seg_from + seg_size, num_pages)
+        seg_from += seg_size
 
 
+def pdf_page_image(page):
+    """The image that can be extracted as it is, None when the page has to be rendered.
 
-def extract_page(vector):
-    """For pages with single image (and no text). Otherwise it's recommended to use render_page()
+    That is a page with a single image and no text. Images without a colorspace
+    or with CCITT fax encoding are rendered too.
+    """
+    if page.get_text().strip() != "":
+        return None
+    image_list = page.get_images()
+    if len(image_list) != 1:
+        return None
+    image = image_list[0]
+    if not image[5] or image[8] == 'CCITTFaxDecode':
+        return None
+    return image
+
+
+def pdf_page_zoom(page, target_width, target_height, pdf_width):
+    if not pdf_width or page.rect.width > page.rect.height:
+        return target_height / page.rect.height
+    return target_width / page.rect.width
+
+
+def render_pdf_page(page, target_width, target_height, pdf_width):
+    zoom = pdf_page_zoom(page, target_width, target_height, pdf_width)
+    mat = pymupdf.Matrix(zoom, zoom)
+    # TODO: decide colorspace earlier so later color check is cheaper.
+    # This is actually pretty hard when you have to deal with color vector text
+    return page.get_pixmap(matrix=mat, colorspace='RGB', alpha=False)
+
+
+def pixmap_image(pix):
+    """The samples of a pixmap as a PIL image, without a PNG round trip.
+
+    The samples are read in place. Pillow unpacks RGB into memory of its own, the modes it
+    maps keep the pixmap alive with the image. A rendered page without any color is handed
+    on as a grayscale copy, it would be treated as such anyway.
+    """
+    # older PyMuPDF only has the copy of the samples
+    samples = pix.samples_mv if hasattr(pix, 'samples_mv') else pix.samples
+    if pix.alpha:
+        mode = 'LA' if pix.n == 2 else 'RGBA'
+    else:
+        mode = 'L' if pix.n == 1 else 'RGB'
+    if mode == 'RGB':
+        pixels = np.frombuffer(samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width * 3]
+        pixels = pixels.reshape(pix.height, pix.width, 3)
+        if (pixels[:, :, 0] == pixels[:, :, 1]).all() and (pixels[:, :, 1] == pixels[:, :, 2]).all():
+            return Image.fromarray(np.ascontiguousarray(pixels[:, :, 0]))
+    image = Image.frombuffer(mode, (pix.width, pix.height), samples, 'raw', mode, pix.stride, 1)
+    if image.readonly:
+        image.pixmap = pix
+    return image
+
+
+class PdfPage:
+    """Page of a PDF that is rendered or extracted by the worker that processes it."""
+    def __init__(self, filename, number, target_width, target_height, pdf_width):
+        self.filename = filename
+        self.number = number
+        self.target_width = target_width
+        self.target_height = target_height
+        self.pdf_width = pdf_width
+
+
+def open_pdf_document(filename):
+    """Document of the streamed pages, kept open for the next pages this process gets."""
+    global pdf_document
+    if pdf_document and pdf_document.name != filename:
+        close_pdf_document()
+    if not pdf_document:
+        pdf_document = pymupdf.open(filename)
+    return pdf_document
+
+
+def close_pdf_document():
+    global pdf_document
+    if pdf_document:
+        pdf_document.close()
+    pdf_document = None
+
+
+def load_pdf_page(pdf):
+    """Stored image of the page as bytes, or the rendered page as a PIL image."""
+    doc = open_pdf_document(pdf.filename)
+    page = doc.load_page(pdf.number)
+    image = pdf_page_image(page)
+    if image:
+        xref = image[0]
+        d = doc.extract_image(xref)
+        if d['cs-name'] != 'DeviceCMYK':
+            return d['image']
+        pix = pymupdf.Pixmap(pymupdf.csRGB, pymupdf.Pixmap(doc, xref))
+    else:
+        pix = render_pdf_page(page, pdf.target_width, pdf.target_height, pdf.pdf_width)
+    return pixmap_image(pix)
+
+
+def process_pdf_pages(vector):
+    """Render or extract a page range of a document.
 
     Notes:
         The PyMuPDF document cannot be part of the argument, because that
-        cannot be pickled. So we are being passed in just its filename.
-        This is no performance issue, because we are a separate process and
-        need to open the document anyway.
-        Any page-specific function can be processed here - rendering is just
-        an example - text extraction might be another.
+        cannot be pickled. So we are being passed in just its filename, the
+        worker keeps the document open for its next ranges.
         The work must however be self-contained: no inter-process communication
         or synchronization is possible with this design.
         Care must also be taken with which parameters are contained in the
@@ -835,76 +1187,74 @@ def extract_page(vector):
         So any large objects will increase the overall duration.
     Args:
         vector: a list containing required parameters.
+    Returns:
+        Numbers of rendered and extracted pages.
     """
     # recreate the arguments
-    idx = vector[0]  # this is the segment number we have to process
-    cpu = vector[1]  # number of CPUs
+    seg_from, seg_to = vector[0], vector[1]  # page range to process
     filename = vector[2]  # document filename
     output_dir = vector[3]
-
-
-    with pymupdf.open(filename) as doc: # open the document
-        num_pages = doc.page_count  # get number of pages
-
-        # pages per segment: make sure that cpu * seg_size >= num_pages!
-        seg_size = int(num_pages / cpu + 1)
-        seg_from = idx * seg_size  # our first page number
-        seg_to = min(seg_from + seg_size, num_pages)  # last page number
-
-        for i in range(seg_from, seg_to):  # work through our page segment
-            output_path = os.path.join(output_dir, "p-%i.png" % i)
-            page = doc.load_page(i)
-            image_list = page.get_images()
-            if len(image_list) > 1:
-                raise UserWarning("mupdf_pdf_extract_page_image() function can be used only with single image pages.")
-            if not image_list:
-                continue
+    target_width = vector[4]
+    target_height = vector[5]
+    pdf_width = vector[6]
+    rendered = extracted = 0
+    doc = open_pdf_document(filename)
+    for i in range(seg_from, seg_to):  # work through our page range
+        output_path = os.path.join(output_dir, "p-%i.png" % i)
+        page = doc.load_page(i)
+        image = pdf_page_image(page)
+        if image:
+            # lossless, the image is saved as it is stored
+            xref = image[0]
+            d = doc.extract_image(xref)
+            if d['cs-name'] == 'DeviceCMYK':
+                pix = pymupdf.Pixmap(doc, xref)
+                pix = pymupdf.Pixmap(pymupdf.csRGB, pix)
+                pix.save(output_path)
             else:
-                xref = image_list[0][0]
-                d = doc.extract_image(xref)
-                if d['cs-name'] == 'DeviceCMYK':
-                    pix = pymupdf.Pixmap(doc, xref)
-                    pix = pymupdf.Pixmap(pymupdf.csRGB, pix)
-                    pix.save(output_path)
-                else:
-                    with open(Path(output_path).with_suffix('.' + d['ext']), "wb") as imgout:
-                        imgout.write(d["image"])
-        print("Processed page numbers %i through %i" % (seg_from, seg_to - 1))
-
+                with open(Path(output_path).with_suffix('.' + d['ext']), "wb") as imgout:
+                    imgout.write(d["image"])
+            extracted += 1
+            continue
+        pix = render_pdf_page(page, target_width, target_height, pdf_width)
+        pix.save(output_path)
+        rendered += 1
+    return rendered, extracted
 
 
 def mupdf_pdf_process_pages_parallel(filename, output_dir, target_width, target_height, pdfwidth):
-    render = False
     with pymupdf.open(filename) as doc:
-        for page in doc:
-            page_text = page.get_text().strip()
-            if page_text != "":
-                render = True
-                break
-            if len(page.get_images()) > 1:
-                render = True
-                break
-            if len(page.get_images()) == 1:
-                image = page.get_images()[0]
-                if not image[5] or image[8] == 'CCITTFaxDecode':
-                    render = True
-                    break
+        num_pages = doc.page_count
 
-    cpu = cpu_count()
+    cpu = options.workers or cpu_count()
 
     # make vectors of arguments for the processes
-    vectors = [(i, cpu, filename, output_dir, target_width, target_height, pdfwidth) for i in range(cpu)]
-    print("Starting %i processes for '%s'." % (cpu, filename))
-
+    vectors = [(seg_from, seg_to, filename, output_dir, target_width, target_height, pdfwidth)
+               for seg_from, seg_to in pdf_page_batches(num_pages, cpu)]
+    print("Starting %i processes for %i pages of '%s'." % (cpu, num_pages, filename))
 
     start = perf_counter()
-    with Pool() as pool:
-        results = pool.map(
-            render_page if render else extract_page, vectors
-        )
+    rendered = extracted = 0
+    try:
+        for page_rendered, page_extracted in getWorkerPool(options.workers).imap_unordered(process_pdf_pages, vectors):
+            rendered += page_rendered
+            extracted += page_extracted
+    finally:
+        # every worker keeps the document open, the source is only released with them (--delete)
+        resetWorkerPool()
     end = perf_counter()
-    print(f"MuPDF: {end - start} sec")
+    print(f"MuPDF: {rendered} pages rendered, {extracted} extracted in {end - start} sec")
+
 
+def getPdfTargetSize():
+    target_width, target_height = options.profileData[1]
+    if options.cropping == 1:
+        target_height *= 1.2 #Account for possible margin at the top and bottom
+        target_width *= 1.2
+    elif options.cropping == 2:
+        target_height *= 1.25 #Account for possible margin at the top and bottom with page number
+        target_width *= 1.25
+    return target_width, target_height
 
 
 def getWorkFolder(afile, options, workdir=None):
@@ -948,13 +1298,7 @@ def getWorkFolder(afile, options, workdir=None):
                 if njpg == 0:
                     raise UserWarning("Failed to extract images from PDF file.")
                 return workdir
-            target_width, target_height = options.profileData[1]
-            if options.cropping == 1:
-                target_height *= 1.2 #Account for possible margin at the top and bottom
-                target_width *= 1.2
-            elif options.cropping == 2:
-                target_height *= 1.25 #Account for possible margin at the top and bottom with page number
-                target_width *= 1.25
+            target_width, target_height = getPdfTargetSize()
             try:
                 mupdf_pdf_process_pages_parallel(afile, fullPath, target_width, target_height, options.pdfwidth)
             except Exception as e:
@@ -1057,7 +1401,123 @@ def getWorkFolder(afile, options, workdir=None):
         raise UserWarning("Failed to open source file/directory.")
 
 
+def getStreamingArchive(afile):
+    if not options.inmemory or not os.path.isfile(afile):
+        return None
+    if options.lightnovel or options.noprocessing or options.webtoon or options.kfx or options.filefusion:
+        return None
+    if getImageFileName(afile)[1] in IMAGE_TYPES + ('.pdf', '.epub') or os.path.exists(afile + '.json'):
+        return None
+    try:
+        cbx = comicarchive.ComicArchive(afile)
+        cbx.members
+    except OSError:
+        return None
+    return cbx
+
+
+def getStreamFolder(afile, cbx, options):
+    """Work folder with an empty placeholder for every image of the archive.
+
+    The tree goes through the usual metadata and sanitizing steps, the images themselves
+    are only decompressed later, straight into the workers.
+    """
+    if options.tempdir:
+        workdir = mkdtemp('', 'KCC-', os.path.dirname(afile))
+    else:
+        workdir = mkdtemp('', 'KCC-')
+    fullPath = os.path.join(workdir, 'OEBPS', 'Images')
+    os.makedirs(fullPath)
+
+    names = []
+    for name, _ in cbx.members:
+        parts = name.split('/')
+        if name.startswith('/') or '..' in parts:
+            continue
+        if any(part in EXCLUDED_MEMBERS or part.startswith('._') for part in parts):
+            continue
+        names.append(name)
+    tdir = {name.split('/')[0] for name in names}
+    if len(tdir) == 2 and 'ComicInfo.xml' in tdir:
+        tdir.remove('ComicInfo.xml')
+    prefix = ''
+    if len(tdir) == 1:
+        top = tdir.pop() + '/'
+        if any(name.startswith(top) for name in names):
+            prefix = top
+
+    tracked = {}
+    for name in names:
+        relative = name[len(prefix):] if name.startswith(prefix) else name
+        if relative == 'ComicInfo.xml' and not os.path.exists(os.path.join(fullPath, relative)):
+            with open(os.path.join(fullPath, relative), 'wb') as f:
+                f.write(cbx.readMember(name))
+        elif getImageFileName(relative)[1] in IMAGE_TYPES:
+            target = os.path.join(fullPath, *relative.split('/'))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            open(target, 'wb').close()
+            tracked[target] = name
+    return workdir, tracked
+
+
+def getStreamingPdf(afile):
+    if not options.inmemory or not os.path.isfile(afile) or getImageFileName(afile)[1] != '.pdf' or options.legacyextract:
+        return False
+    if options.lightnovel or options.noprocessing or options.webtoon or options.kfx or options.filefusion:
+        return False
+    return not os.path.exists(afile + '.json')
+
+
+def getPdfStreamFolder(afile, options):
+    """Work folder with an empty placeholder for every page of the PDF.
+
+    The pages are rendered (or their image is extracted) by the workers that process them,
+    they never go through a PNG file.
+    """
+    if options.tempdir:
+        workdir = mkdtemp('', 'KCC-', os.path.dirname(afile))
+    else:
+        workdir = mkdtemp('', 'KCC-')
+    fullPath = os.path.join(workdir, 'OEBPS', 'Images')
+    os.makedirs(fullPath)
+    target_width, target_height = getPdfTargetSize()
+    with pymupdf.open(afile) as doc:
+        num_pages = doc.page_count
+    tracked = {}
+    for i in range(num_pages):
+        target = os.path.join(fullPath, "p-%i.png" % i)
+        open(target, 'wb').close()
+        tracked[target] = PdfPage(afile, i, target_width, target_height, options.pdfwidth)
+    return workdir, tracked
+
+
+def streamPdfPages(tracked):
+    for path, page in sorted(tracked.items(), key=lambda item: item[1].number):
+        dirpath, afile = os.path.split(path)
+        yield [afile, dirpath, options, page]
+
+
+def getStreamedSource(cbx, tracked, path):
+    """Cover source of a streamed book."""
+    if cbx:
+        return BytesIO(cbx.readMember(tracked[path]))
+    try:
+        data = load_pdf_page(tracked[path])
+    finally:
+        # a forked worker must not share the open document of the main process
+        close_pdf_document()
+    return BytesIO(data) if isinstance(data, bytes) else data
+
+
+def streamArchivePages(cbx, pages):
+    for name, data in cbx.iterMembers():
+        if name in pages:
+            dirpath, afile = os.path.split(pages[name])
+            yield [afile, dirpath, options, data]
+
+
 def getOutputFilename(srcpath, wantedname, ext, tomenumber):
+    tomenumber = options.outputsuffix + tomenumber
     source_path = Path(srcpath)
     if srcpath[-1] == os.path.sep:
         srcpath = srcpath[:-1]
@@ -1090,7 +1550,7 @@ def getOutputFilename(srcpath, wantedname, ext, tomenumber):
                 name = re.sub(r'\W+', '_', source_path.stem) + tomenumber + ext
             else:
                 name = re.sub(r'\W+', '_', source_path.name) + tomenumber + ext
-            filename = source_path.with_name(name)
+            filename = str(source_path.with_name(name))
         else:
             filename = os.path.splitext(srcpath)[0] + tomenumber + ext
     if os.path.isfile(filename):
@@ -1185,10 +1645,10 @@ def getMetadata(path, originalpath):
 
 def getDirectorySize(start_path='.'):
     total_size = 0
-    for dirpath, _, filenames in os.walk(start_path):
+    for dirpath, _, filenames in pageStore.walk(start_path):
         for f in filenames:
             fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
+            total_size += pageStore.getsize(fp)
     return total_size
 
 
@@ -1230,7 +1690,7 @@ def removeNonImages(filetree):
         raise RuntimeError('\n'.join(warning))
 
 
-def sanitizeTree(filetree, options, prefix='kcc'):
+def sanitizeTree(filetree, options, prefix='kcc', tracked=None):
     chapterNames = {}
     page = 1
     cover_path = None
@@ -1246,7 +1706,9 @@ def sanitizeTree(filetree, options, prefix='kcc'):
             newKey = os.path.join(root, unique_name + ext)
             key = os.path.join(root, name)
             if key != newKey:
-                os.replace(key, newKey)
+                pageStore.replace(key, newKey)
+                if tracked is not None and key in tracked:
+                    tracked[newKey] = tracked.pop(key)
             if not cover_path:
                 cover_path = newKey
         is_natural_sorted = False
@@ -1262,15 +1724,18 @@ def sanitizeTree(filetree, options, prefix='kcc'):
             newKey = os.path.join(root, slugified)
             key = os.path.join(root, name)
             if key != newKey:
-                os.replace(key, newKey)
+                pageStore.replace(key, newKey)
                 dirs[i] = newKey
+                if tracked is not None:
+                    for path in [path for path in tracked if path.startswith(key + os.sep)]:
+                        tracked[newKey + path[len(key):]] = tracked.pop(path)
     return chapterNames, cover_path
 
 
 def flattenTree(filetree):
-    for root, dirs, files in os.walk(filetree, topdown=False):
+    for root, dirs, files in pageStore.walk(filetree, topdown=False):
         for name in files:
-            os.rename(os.path.join(root, name), os.path.join(filetree, name))
+            pageStore.move(os.path.join(root, name), os.path.join(filetree, name))
         for name in dirs:
             os.rmdir(os.path.join(root, name))
 
@@ -1287,7 +1752,7 @@ def sanitizePermissions(filetree):
 
 def chunk_directory(path):
     level = -1
-    for root, _, files in os.walk(os.path.join(path, 'OEBPS', 'Images')):
+    for root, _, files in pageStore.walk(os.path.join(path, 'OEBPS', 'Images')):
         for f in files:
             # Windows MAX_LEN = 260 plus some buffer
             if os.name == 'nt' and len(os.path.join(root, f)) > 220:
@@ -1334,14 +1799,14 @@ def chunk_process(path, mode, parent):
                         mode = 1
                         break
     if mode < 3:
-        for root, dirs, files in walkLevel(path, 0):
+        for root, dirs, files in walkLevel(path, 0, pageStore.walk):
             for name in files if mode == 1 else dirs:
                 size = 0
                 if mode == 1: 
                     if 'below' not in name:
-                        size = os.path.getsize(os.path.join(root, name))
+                        size = pageStore.getsize(os.path.join(root, name))
                         if 'above' in name:
-                            size += os.path.getsize(os.path.join(root, name.replace('above', 'below')))
+                            size += pageStore.getsize(os.path.join(root, name.replace('above', 'below')))
                 else:
                     size = getDirectorySize(os.path.join(root, name))
                 if currentSize + size > targetSize:
@@ -1351,7 +1816,7 @@ def chunk_process(path, mode, parent):
                 else:
                     currentSize += size
                 if path != currentTarget:
-                    move(os.path.join(root, name), os.path.join(currentTarget, name))
+                    pageStore.move(os.path.join(root, name), os.path.join(currentTarget, name))
     else:
         firstTome = True
         for root, dirs, _ in walkLevel(path, 0):
@@ -1359,14 +1824,13 @@ def chunk_process(path, mode, parent):
                 if not firstTome:
                     currentTarget, pathRoot = createNewTome(parent)
                     output.append(pathRoot)
-                    move(os.path.join(root, name), os.path.join(currentTarget, name))
+                    pageStore.move(os.path.join(root, name), os.path.join(currentTarget, name))
                 else:
                     firstTome = False
     return output
 
 def detectSuboptimalProcessing(tmppath, orgpath):
-    imageNumber = 0
-    imageSmaller = 0
+    sizes = []
     alreadyProcessed = False
     for root, _, files in os.walk(tmppath, False):
         for name in files:
@@ -1380,10 +1844,8 @@ def detectSuboptimalProcessing(tmppath, orgpath):
                     raise RuntimeError('Image file %s is corrupted.' % pathOrg)
                 try:
                     img = Image.open(path)
-                    imageNumber += 1
-                    # count images smaller than device resolution
-                    if options.profileData[1][0] > img.size[0] and options.profileData[1][1] > img.size[1]:
-                        imageSmaller += 1
+                    pageStore.setrecord(PageRecord(path, img.size, [], img.mode not in ('1', 'L', 'LA'), img.format))
+                    sizes.append(img.size)
                 except Exception as err:
                     rmtree(os.path.join(tmppath, '..', '..'), True)
                     if 'decoder' in str(err) and 'not available' in str(err):
@@ -1396,13 +1858,20 @@ def detectSuboptimalProcessing(tmppath, orgpath):
                         os.remove(os.path.join(root, name))
                 except OSError as e:
                     raise RuntimeError(f"{name}: {e}")
+    warnSuboptimalProcessing(alreadyProcessed, sizes)
+
+
+def warnSuboptimalProcessing(alreadyProcessed, sizes):
+    # count images smaller than device resolution
+    imageSmaller = sum(1 for width, height in sizes
+                       if options.profileData[1][0] > width and options.profileData[1][1] > height)
     if alreadyProcessed:
         print("WARNING: Source files are probably created by KCC. The second conversion will decrease quality.")
         if GUI:
             GUI.addMessage.emit('Source files are probably created by KCC. The second conversion will decrease quality.'
                                 , 'warning', False)
             GUI.addMessage.emit('', '', False)
-    if imageSmaller > imageNumber * 0.25 and not options.upscale and not options.stretch and not options.profile.startswith('KS'):
+    if imageSmaller > len(sizes) * 0.25 and not options.upscale and not options.stretch and not options.profile.startswith('KS'):
         print("WARNING: More than 25% of images are smaller than target device resolution. "
               "Consider enabling stretching or upscaling to improve readability.")
         if GUI:
@@ -1431,26 +1900,15 @@ def slugify(value, options, is_natural_sorted):
 
 def makeZIP(zipfilename, basedir, job_progress='', isepub=False):
     start = perf_counter()
-    if SEVENZIP in available_archive_tools():
-        if isepub:
-            mimetypeFile = open(os.path.join(basedir, '!mimetype'), 'w')
-            mimetypeFile.write('application/epub+zip')
-            mimetypeFile.close()
-        subprocess_run([SEVENZIP, 'a', '-mx0', '-tzip', zipfilename, "*"], capture_output=True, check=True, cwd=basedir)
-        # crazy hack to ensure mimetype is first when using 7zip
-        if isepub:
-            subprocess_run([SEVENZIP, 'rn', zipfilename, '!mimetype', 'mimetype'], capture_output=True, check=True, cwd=basedir)
+    if pageSink and pageSink.filename == zipfilename:
+        pageSink.close()
     else:
-        zipOutput = ZipFile(zipfilename, 'w', ZIP_STORED)
-        if isepub:
-            zipOutput.writestr('mimetype', 'application/epub+zip', ZIP_STORED)
-        for dirpath, _, filenames in os.walk(basedir):
-            for name in filenames:
-                path = os.path.normpath(os.path.join(dirpath, name))
-                aPath = os.path.normpath(os.path.join(dirpath.replace(basedir, ''), name))
-                if os.path.isfile(path):
-                    zipOutput.write(path, aPath)
-        zipOutput.close()
+        sink = ZipSink(zipfilename, basedir, pageStore, isepub)
+        try:
+            sink.close()
+        except BaseException:
+            sink.abort()
+            raise
     end = perf_counter()
     print(f"{job_progress}makeZIP time: {end - start} seconds")
     return zipfilename
@@ -1470,6 +1928,7 @@ def makeParser():
 
     main_options.add_argument("-p", "--profile", action="store", dest="profile", default="KV",
                               help=f"Device profile (Available options: {', '.join(image.ProfileData.Profiles.keys())})"
+                                   " Separate several profiles with commas to convert for all of them at once."
                                    " [Default=KV]")
     main_options.add_argument("-m", "--manga-style", action="store_true", dest="righttoleft", default=False,
                               help="Manga style (right-to-left reading and splitting)")
@@ -1509,6 +1968,8 @@ def makeParser():
                                      "[Default=Auto]")
     output_options.add_argument("--nokepub", action="store_true", dest="noKepub", default=False,
                                 help="If format is EPUB, output file with '.epub' extension rather than '.kepub.epub'")
+    output_options.add_argument("--fastpdf", action="store_true", dest="fastpdf", default=False,
+                                help="If format is PDF, save without deduplicating images. Faster for long books, slightly larger files.")
     output_options.add_argument("-b", "--batchsplit", type=int, dest="batchsplit", default="0",
                                 help="Split output into multiple files. 0: Don't split 1: Automatic mode "
                                      "2: Consider every subdirectory as separate volume [Default=0]")
@@ -1587,6 +2048,23 @@ def makeParser():
                                     help="Delete source file(s) or a directory. It's not recoverable.")
     processing_options.add_argument("--tempdir", action="store_true", dest="tempdir", default=False,
                                     help="Create temporary files directory on source file drive.")
+    processing_options.add_argument("--inmemory", action="store_true", dest="inmemory", default=False,
+                                    help="Keep processed images in memory instead of temporary files. "
+                                         "Falls back to temporary files when memory runs low. "
+                                         "Archive pages are decompressed and PDF pages rendered straight into the workers.")
+    processing_options.add_argument("--cachedir", type=str, dest="cachedir", default=None,
+                                    help="Reuse processed pages of earlier conversions stored in this directory.")
+    processing_options.add_argument("--cachesize", type=int, dest="cachesize", default=1024,
+                                    help="Maximal size of the page cache in MB. [Default=1024]")
+    processing_options.add_argument("--workers", type=int, dest="workers", default=0,
+                                    help="Number of worker processes. [Default=number of CPUs]")
+    processing_options.add_argument("--jobs", type=int, dest="jobs", default=1,
+                                    help="Number of books converted at the same time. [Default=1]")
+    processing_options.add_argument("--max-memory", type=int, dest="maxmemory", default=0,
+                                    help="Memory in MB the workers may use for images at the same time. "
+                                         "Pages wait until enough is free. [Default=0 (no limit)]")
+    processing_options.add_argument("--profile-report", action="store", dest="profilereport", default=None,
+                                    help="Save time spent in every image processing stage to this JSON file")
 
     custom_profile_options.add_argument("--customwidth", type=int, dest="customwidth", default=0,
                                         help="Replace screen width provided by device profile")
@@ -1600,6 +2078,22 @@ def makeParser():
 
 
 def checkOptions(options):
+    # several comma separated profiles are converted in one pass, see getTargetOptions
+    if ',' in options.profile:
+        if options.webtoon or options.lightnovel or options.noprocessing or 'KFX' in options.format:
+            raise UserWarning('Webtoon, light novel, KFX and no processing modes support only one profile.')
+        if options.customwidth != 0 or options.customheight != 0:
+            raise UserWarning('Custom resolution supports only one profile.')
+        targets = []
+        for profile in options.profile.split(','):
+            target = copy(options)
+            target.profile = profile.strip()
+            targets.append(checkOptions(target))
+        options = copy(targets[0])
+        options.targets = targets
+        return options
+    options.targets = []
+    options.outputsuffix = ''
     options.panelview = True
     options.iskindle = False
     options.isKobo = False
@@ -1747,6 +2241,36 @@ def checkPre(source='KCC-'):
             if tempdir.startswith(source):
                 rmtree(os.path.join(root, tempdir), True)
 
+def getTargetOptions(path):
+    """Options and work folder for every profile of a multi-profile conversion.
+
+    Metadata found so far is kept, only the values that checkOptions derived differently
+    for a profile are replaced. The first profile works in the source tree.
+    """
+    targets = []
+    first = vars(options.targets[0])
+    for profile in options.targets:
+        target = copy(options)
+        target.targets = []
+        target.__dict__.update({k: v for k, v in vars(profile).items() if k not in first or first[k] != v})
+        target.outputsuffix += ' ' + target.profile
+        if not targets:
+            target.workdir = path
+        else:
+            target.workdir = mkdtemp('', 'KCC-', os.path.dirname(path))
+            copytree(os.path.join(path, 'OEBPS', 'Images'), os.path.join(target.workdir, 'OEBPS', 'Images'),
+                     ignore=lambda root, names: [name for name in names if not os.path.isdir(os.path.join(root, name))])
+        targets.append(target)
+    options.workdir = path
+    return targets
+
+
+def removeWorkFolders(path):
+    rmtree(os.path.join(path, '..', '..'), True)
+    for target in options.targets:
+        rmtree(target.workdir, True)
+
+
 def makeFusion(sources: List[str]):
     if len(sources) < 2:
         raise UserWarning('Fusion requires at least 2 sources. Did you forget to uncheck fusion?')
@@ -1799,17 +2323,31 @@ def makeFusion(sources: List[str]):
 
 def makeBook(source, qtgui=None, job_progress=''):
     start = perf_counter()
-    global GUI
+    global GUI, pageStore, pageSink, options
     GUI = qtgui
+    pageSink = None
+    if options.inmemory:
+        pageStore = PageStore(virtual_memory().available // 4 // jobCount)
+    else:
+        pageStore = PageStore()
     if GUI:
         GUI.progressBarTick.emit('1')
     else:
         checkTools(source)
-    checkPre()
-    if not options.filefusion:
-        checkPre('LLL-')
+    # with several jobs the temporary folders of the others are still in use
+    if jobCount == 1:
+        checkPre()
+        if not options.filefusion:
+            checkPre('LLL-')
     print(f"{job_progress}Preparing source images...")
-    path = getWorkFolder(source, options)
+    cbx = getStreamingArchive(source)
+    tracked = None
+    if cbx:
+        path, tracked = getStreamFolder(source, cbx, options)
+    elif getStreamingPdf(source):
+        path, tracked = getPdfStreamFolder(source, options)
+    else:
+        path = getWorkFolder(source, options)
     print(f"{job_progress}Checking images...")
 
     if options.lightnovel:
@@ -1842,8 +2380,12 @@ def makeBook(source, qtgui=None, job_progress=''):
 
     getMetadata(os.path.join(path, "OEBPS", "Images"), source)
     removeNonImages(os.path.join(path, "OEBPS", "Images"))
-    detectSuboptimalProcessing(os.path.join(path, "OEBPS", "Images"), source)
-    chapterNames, cover_path = sanitizeTree(os.path.join(path, 'OEBPS', 'Images'), options)
+    if tracked is None:
+        detectSuboptimalProcessing(os.path.join(path, "OEBPS", "Images"), source)
+    else:
+        # the placeholders still have the names of the source images
+        alreadyProcessed = any('-kcc' in getImageFileName(os.path.basename(name))[0] for name in tracked)
+    chapterNames, cover_path = sanitizeTree(os.path.join(path, 'OEBPS', 'Images'), options, tracked=tracked)
 
     if os.path.exists(source+'.json'):
         flattenTree(os.path.join(path, 'OEBPS', 'Images'))
@@ -1867,12 +2409,19 @@ def makeBook(source, qtgui=None, job_progress=''):
         # Strip the fusion_0001_ sort prefix from makeFusion if present
         chapterNames = {k: sub(r'^fusion_\d{4}_', '', v) for k, v in chapterNames.items()}
     cover = None
-    if not options.webtoon:
+    if tracked is not None:
+        cover = image.Cover(getStreamedSource(cbx, tracked, cover_path), options)
+    elif not options.webtoon:
         cover = image.Cover(cover_path, options)
 
     x, y = image.ProfileData.Profiles[options.profile][1]
     if options.webtoon:
-        comic2panel.main(['-y ' + str(y), '-x' + str(x), '-i', '-m', path], job_progress, qtgui)
+        argv = ['-y ' + str(y), '-x' + str(x), '-i', '-m', path]
+        if options.maxmemory:
+            argv[-1:-1] = ['--max-memory', str(options.maxmemory // jobCount)]
+        comic2panel.main(argv, job_progress, qtgui)
+        # the strips were split and merged again, the records of the source images are wrong now
+        pageStore.discard(path)
 
     options.kfx_resolution = None
     if options.kfx:
@@ -1880,6 +2429,11 @@ def makeBook(source, qtgui=None, job_progress=''):
         normalized_resolutions = []
         for root, _, files in os.walk(os.path.join(path, "OEBPS", "Images")):
             for file in files:
+                record = pageStore.getrecord(os.path.join(root, file))
+                if record:
+                    original_resolutions.append(record.size)
+                    normalized_resolutions.append(get_contain_resolution(record, (x, y)))
+                    continue
                 with Image.open(os.path.join(root, file)) as imagef:
                     original_resolutions.append(imagef.size)
                     size = get_contain_resolution(imagef, (x, y))
@@ -1907,15 +2461,91 @@ def makeBook(source, qtgui=None, job_progress=''):
         # else:
         #     raise UserWarning('Aspect ratio of pages too different for KFX conversion')
 
-    if options.noprocessing:
-        print(f"{job_progress}Do not process image, ignore any profile or processing option")
-    else:
-        print(f"{job_progress}Processing images...")
+    try:
+        if options.targets:
+            if tracked is not None:
+                covers = [image.Cover(getStreamedSource(cbx, tracked, cover_path), target) for target in options.targets]
+            else:
+                covers = [image.Cover(cover_path, target) for target in options.targets]
+            options.targets = getTargetOptions(path)
+
+        # a single tome can be packed while its pages are being processed
+        elif options.format != 'PDF' and not options.batchsplit and not options.targetsize:
+            if options.format == 'CBZ':
+                pageSink = ZipSink(getOutputFilename(source, options.output, '.cbz', ''),
+                                   os.path.join(path, 'OEBPS', 'Images'), pageStore)
+                if cover and cover.smartcover:
+                    smartcover = BytesIO()
+                    cover.save_to_folder(smartcover, 0)
+                    pageSink.writestr('##cover.jpg', smartcover.getvalue())
+            else:
+                pageSink = ZipSink(getOutputFilename(source, options.output, '.epub', ''), path, pageStore, True)
+
+        if options.noprocessing:
+            print(f"{job_progress}Do not process image, ignore any profile or processing option")
+        else:
+            print(f"{job_progress}Processing images...")
+            if GUI:
+                GUI.progressBarTick.emit(f'{job_progress}Processing images')
+            if cbx:
+                pages = {name: path for path, name in tracked.items()}
+                imgDirectoryProcessing(os.path.join(path, "OEBPS", "Images"), job_progress,
+                                       streamArchivePages(cbx, pages), len(pages))
+            elif tracked is not None:
+                try:
+                    imgDirectoryProcessing(os.path.join(path, "OEBPS", "Images"), job_progress,
+                                           streamPdfPages(tracked), len(tracked))
+                finally:
+                    # every worker keeps the document open, the source is only released with them (--delete)
+                    resetWorkerPool()
+            else:
+                imgDirectoryProcessing(os.path.join(path, "OEBPS", "Images"), job_progress)
+            if tracked is not None:
+                # the workers reported the sizes of the streamed pages, cached pages are not counted
+                warnSuboptimalProcessing(alreadyProcessed, sourceSizes)
         if GUI:
-            GUI.progressBarTick.emit(f'{job_progress}Processing images')
-        imgDirectoryProcessing(os.path.join(path, "OEBPS", "Images"), job_progress)
-    if GUI:
-        GUI.progressBarTick.emit('1')
+            GUI.progressBarTick.emit('1')
+        if options.targets:
+            filepath = []
+            base = options
+            try:
+                for target, targetCover in zip(base.targets, covers):
+                    options = target
+                    output, done = makeTomes(source, target.workdir, chapterNames, targetCover, job_progress)
+                    filepath += output
+                    if not done:
+                        return filepath
+            finally:
+                options = base
+        else:
+            filepath, done = makeTomes(source, path, chapterNames, cover, job_progress)
+            if not done:
+                return filepath
+    except BaseException:
+        # nothing is left under the name of an unfinished book
+        if pageSink:
+            pageSink.abort()
+        raise
+    if options.delete:
+        if os.path.isfile(source):
+            os.remove(source)
+        elif os.path.isdir(source):
+            rmtree(source, True)
+
+    end = perf_counter()
+    print(f"{job_progress}makeBook: {end - start} seconds")
+    if options.profilereport:
+        profileReport.append({'source': source, 'profile': options.profile, 'format': options.format,
+                              'seconds': end - start, **pageStats})
+
+    if options.filefusion:
+        rmtree(source, True)
+        checkPre('LLL-')
+
+    return filepath
+
+
+def makeTomes(source, path, chapterNames, cover, job_progress=''):
     if options.batchsplit > 0 or options.targetsize:
         tomes = chunk_directory(path)
     else:
@@ -1943,7 +2573,9 @@ def makeBook(source, qtgui=None, job_progress=''):
             options.title = options.baseTitle + ' [' + str(tomeNumber) + '/' + str(len(tomes)) + ']'
         if options.format == 'CBZ':
             print(f"{job_progress}Creating CBZ file...")
-            if len(tomes) > 1:
+            if pageSink:
+                filepath.append(pageSink.filename)
+            elif len(tomes) > 1:
                 filepath.append(getOutputFilename(source, options.output, '.cbz', ' ' + str(tomeNumber)))
             else:
                 filepath.append(getOutputFilename(source, options.output, '.cbz', ''))
@@ -1970,9 +2602,10 @@ def makeBook(source, qtgui=None, job_progress=''):
                 filepath.append(getOutputFilename(source, options.output, '.epub', ' ' + str(tomeNumber)))
             else:
                 buildEPUB(tome, chapterNames, tomeNumber, False, cover, source, job_progress)
-                filepath.append(getOutputFilename(source, options.output, '.epub', ''))
+                filepath.append(pageSink.filename if pageSink else getOutputFilename(source, options.output, '.epub', ''))
             makeZIP(filepath[-1], tome, job_progress, True)
         rmtree(tome, True)
+        pageStore.discard(tome)
         if GUI:
             GUI.progressBarTick.emit('tick')
     if not GUI and options.format == 'MOBI' and not options.lightnovel:
@@ -1985,7 +2618,7 @@ def makeBook(source, qtgui=None, job_progress=''):
             if errors[0] != 0:
                 print(f"{job_progress}Error: KindleGen failed to create MOBI!")
                 print(errors)
-                return filepath
+                return filepath, False
         k = kindle.Kindle(options.profile)
         if k.path and k.coverSupport:
             print(f"{job_progress}Kindle detected. Uploading covers...")
@@ -1993,23 +2626,10 @@ def makeBook(source, qtgui=None, job_progress=''):
             output = makeMOBIFix(i, options.covers[filepath.index(i)][1])
             if not output[0]:
                 print(f'{job_progress}Error: Failed to tweak KindleGen output!')
-                return filepath
+                return filepath, False
             if cover and k.path and k.coverSupport:
                 options.covers[filepath.index(i)][0].saveToKindle(k, options.covers[filepath.index(i)][1])
-    if options.delete:
-        if os.path.isfile(source):
-            os.remove(source)
-        elif os.path.isdir(source):
-            rmtree(source, True)
-
-    end = perf_counter()
-    print(f"{job_progress}makeBook: {end - start} seconds")
-
-    if options.filefusion:
-        rmtree(source, True)
-        checkPre('LLL-')
-
-    return filepath
+    return filepath, True
 
 
 def makeMOBIFix(item, uuid):
@@ -2114,7 +2734,8 @@ def makeMOBI(work, qtgui=None):
         threadNumber = 4
     else:
         threadNumber = None
-    makeMOBIWorkerPool = Pool(threadNumber, maxtasksperchild=10)
+    # the workers only wait for KindleGen
+    makeMOBIWorkerPool = ThreadPool(threadNumber)
     for i in work:
         makeMOBIWorkerPool.apply_async(func=makeMOBIWorker, args=(i, ), callback=makeMOBIWorkerTick)
     makeMOBIWorkerPool.close()
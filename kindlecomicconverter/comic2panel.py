@@ -23,22 +23,43 @@ import os
 import sys
 from argparse import ArgumentParser
 from shutil import rmtree
-from multiprocessing import Pool
 from PIL import Image, ImageChops, ImageOps, ImageDraw, ImageFilter, ImageFile
 from PIL.Image import Dither
-from .shared import dot_clean, getImageFileName, walkLevel, walkSort, sanitizeTrace
+from .lut import thresholdTable
+from .shared import dot_clean, getImageFileName, walkLevel, walkSort, sanitizeTrace, getWorkerPool, resetWorkerPool, \
+    getChunkSize, MemoryBudget
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
+# peak memory of a worker per pixel of the images it merges or splits
+PANEL_MEMORY = 8
+
+
+def imagePixels(paths):
+    # only the headers are read, broken files are left to the worker
+    pixels = 0
+    for path in paths:
+        try:
+            with Image.open(path) as im:
+                pixels += im.width * im.height
+        except Exception:
+            pass
+    return pixels
+
+
+def mergeDirectoryMemory(work):
+    files = [os.path.join(root, name) for root, _, names in walkLevel(work[0], 0) for name in names]
+    return imagePixels(files) * PANEL_MEMORY
+
+
+def mergeDirectoryTask(task):
+    return task[0], mergeDirectory(task[1])
 
 
 def mergeDirectoryTick(output):
     if output:
         mergeWorkerOutput.append(output)
-        mergeWorkerPool.terminate()
     if GUI:
         GUI.progressBarTick.emit('tick')
-        if not GUI.conversionAlive:
-            mergeWorkerPool.terminate()
 
 
 def mergeDirectory(work):
@@ -89,11 +110,16 @@ def detectSolid(img):
 def splitImageTick(output):
     if output:
         splitWorkerOutput.append(output)
-        splitWorkerPool.terminate()
     if GUI:
         GUI.progressBarTick.emit('tick')
-        if not GUI.conversionAlive:
-            splitWorkerPool.terminate()
+
+
+def splitImageMemory(work):
+    return imagePixels([os.path.join(work[0], work[1])]) * PANEL_MEMORY
+
+
+def splitImageTask(task):
+    return task[0], splitImage(task[1])
 
 
 # noinspection PyUnboundLocalVariable
@@ -109,7 +135,7 @@ def splitImage(work):
         # I experimented with custom vertical edge kernel [-1, 2, -1] but got poor results
         imgEdges = Image.open(filePath).convert('L').filter(ImageFilter.FIND_EDGES)
         # threshold of 8 is too high. 5 is too low.
-        imgProcess = imgEdges.point(lambda p: 255 if p > 6 else 0).convert('1', dither=Dither.NONE)
+        imgProcess = imgEdges.point(thresholdTable(7)).convert('1', dither=Dither.NONE)
 
         widthImg, heightImg = imgOrg.size
         if heightImg > opt.height:
@@ -223,7 +249,7 @@ def splitImage(work):
 
 
 def main(argv=None, job_progress='', qtgui=None):
-    global args, GUI, splitWorkerPool, splitWorkerOutput, mergeWorkerPool, mergeWorkerOutput
+    global args, GUI, splitWorkerOutput, mergeWorkerOutput
     parser = ArgumentParser(prog="kcc-c2p", usage="kcc-c2p [options] [input]", add_help=False)
 
     mandatory_options = parser.add_argument_group("MANDATORY")
@@ -242,6 +268,9 @@ def main(argv=None, job_progress='', qtgui=None):
                               help="Combine every directory into a single image before splitting")
     other_options.add_argument("-d", "--debug", action="store_true", dest="debug", default=False,
                                help="Create debug file for every split image")
+    other_options.add_argument("--max-memory", type=int, dest="maxmemory", default=0,
+                               help="Memory in MB the workers may use for images at the same time. "
+                                    "Images wait until enough is free. [Default=0 (no limit)]")
     other_options.add_argument("-h", "--help", action="help",
                                help="Show this help message and exit")
     args = parser.parse_args(argv)
@@ -259,13 +288,11 @@ def main(argv=None, job_progress='', qtgui=None):
                 work = []
                 pagenumber = 1
                 splitWorkerOutput = []
-                splitWorkerPool = Pool(maxtasksperchild=10)
                 if args.merge:
                     print(f"{job_progress}Merging images...")
                     directoryNumer = 1
                     mergeWork = []
                     mergeWorkerOutput = []
-                    mergeWorkerPool = Pool(maxtasksperchild=10)
                     mergeWork.append([targetDir])
                     for root, dirs, files in os.walk(targetDir, False):
                         dirs, files = walkSort(dirs, files)
@@ -275,10 +302,22 @@ def main(argv=None, job_progress='', qtgui=None):
                     if GUI:
                         GUI.progressBarTick.emit(f'{job_progress}Combining images')
                         GUI.progressBarTick.emit(str(directoryNumer))
-                    for i in mergeWork:
-                        mergeWorkerPool.apply_async(func=mergeDirectory, args=(i, ), callback=mergeDirectoryTick)
-                    mergeWorkerPool.close()
-                    mergeWorkerPool.join()
+                    budget = MemoryBudget(args.maxmemory * 1024 * 1024) if args.maxmemory else None
+                    tasks = enumerate(mergeWork)
+                    if budget:
+                        tasks = budget.admit(tasks, mergeDirectoryMemory)
+                    try:
+                        for index, output in getWorkerPool().imap_unordered(mergeDirectoryTask, tasks):
+                            if budget:
+                                budget.release(index)
+                            mergeDirectoryTick(output)
+                            if len(mergeWorkerOutput) > 0 or (GUI and not GUI.conversionAlive):
+                                break
+                    finally:
+                        if budget:
+                            budget.close()
+                    if len(mergeWorkerOutput) > 0 or (GUI and not GUI.conversionAlive):
+                        resetWorkerPool()
                     if GUI and not GUI.conversionAlive:
                         rmtree(targetDir, True)
                         raise UserWarning("Conversion interrupted.")
@@ -300,10 +339,23 @@ def main(argv=None, job_progress='', qtgui=None):
                     GUI.progressBarTick.emit(str(pagenumber))
                     GUI.progressBarTick.emit('tick')
                 if len(work) > 0:
-                    for i in work:
-                        splitWorkerPool.apply_async(func=splitImage, args=(i, ), callback=splitImageTick)
-                    splitWorkerPool.close()
-                    splitWorkerPool.join()
+                    budget = MemoryBudget(args.maxmemory * 1024 * 1024) if args.maxmemory else None
+                    tasks = enumerate(work)
+                    if budget:
+                        tasks = budget.admit(tasks, splitImageMemory)
+                    try:
+                        for index, output in getWorkerPool().imap_unordered(splitImageTask, tasks,
+                                                                            1 if budget else getChunkSize(len(work))):
+                            if budget:
+                                budget.release(index)
+                            splitImageTick(output)
+                            if len(splitWorkerOutput) > 0 or (GUI and not GUI.conversionAlive):
+                                break
+                    finally:
+                        if budget:
+                            budget.close()
+                    if len(splitWorkerOutput) > 0 or (GUI and not GUI.conversionAlive):
+                        resetWorkerPool()
                     dot_clean(targetDir)
                     if GUI and not GUI.conversionAlive:
                         rmtree(targetDir, True)
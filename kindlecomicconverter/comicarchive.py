@@ -25,11 +25,13 @@ import platform
 from subprocess import STDOUT, PIPE, CalledProcessError
 from xml.dom.minidom import parseString
 from xml.parsers.expat import ExpatError
-from .shared import IMAGE_TYPES, subprocess_run
+from zipfile import ZipFile, is_zipfile
+from .shared import IMAGE_TYPES, subprocess_run, subprocess_popen
 
 EXTRACTION_ERROR = 'Failed to extract archive. Try extracting file outside of KCC.'
 SEVENZIP = '7zz' if platform.system() == 'Darwin' else '7z'
 TAR = 'bsdtar' if platform.system() == 'Linux' else 'tar'
+EXCLUDED_MEMBERS = ('__MACOSX', '.DS_Store', 'thumbs.db', 'Thumbs.db')
 
 
 class ComicArchive:
@@ -103,6 +105,70 @@ class ComicArchive:
         else:
             raise OSError(EXTRACTION_ERROR)
 
+    @cached_property
+    def members(self):
+        """File members as (name, size) pairs in archive order."""
+        if is_zipfile(self.filepath):
+            with ZipFile(self.filepath) as zf:
+                return [(i.filename, i.file_size) for i in zf.infolist() if not i.is_dir()]
+        try:
+            process = subprocess_run([SEVENZIP, 'l', '-slt', '-y', '-p1', self.basename],
+                                     capture_output=True, check=True, cwd=self.dirname)
+        except (FileNotFoundError, CalledProcessError):
+            raise OSError(EXTRACTION_ERROR)
+        members = []
+        entry = {}
+        # the archive itself is described first, its properties end at the first dashed line
+        listing = process.stdout.decode('utf-8', errors='replace').split('----------', 1)[-1]
+        for line in listing.splitlines() + ['']:
+            if ' = ' in line:
+                key, value = line.split(' = ', 1)
+                entry[key] = value
+            elif entry:
+                if 'Path' in entry and entry.get('Folder') != '+' and 'D' not in entry.get('Attributes', '')[:1]:
+                    members.append((entry['Path'].replace('\\', '/'), int(entry.get('Size') or 0)))
+                entry = {}
+        return members
+
+    def iterMembers(self):
+        """Yield (name, data) for every file member while the archive is being decompressed.
+
+        ZIP archives are read natively, everything else is piped out of a single 7z process
+        and cut apart using the sizes from the listing.
+        """
+        if is_zipfile(self.filepath):
+            with ZipFile(self.filepath) as zf:
+                for info in zf.infolist():
+                    if not info.is_dir():
+                        yield info.filename, zf.read(info)
+            return
+        members = self.members
+        try:
+            process = subprocess_popen([SEVENZIP, 'x', '-so', '-y', '-p1', self.basename],
+                                       stdout=PIPE, stderr=PIPE, cwd=self.dirname)
+        except FileNotFoundError:
+            raise OSError(EXTRACTION_ERROR)
+        try:
+            for name, size in members:
+                data = process.stdout.read(size)
+                if len(data) != size:
+                    raise OSError(EXTRACTION_ERROR)
+                yield name, data
+        finally:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+
+    def readMember(self, name):
+        if is_zipfile(self.filepath):
+            with ZipFile(self.filepath) as zf:
+                return zf.read(name)
+        process = subprocess_run([SEVENZIP, 'x', '-so', '-y', '-p1', self.basename, name],
+                                 capture_output=True, cwd=self.dirname)
+        if process.returncode != 0:
+            raise OSError(EXTRACTION_ERROR)
+        return process.stdout
+
     def addFile(self, sourcefile):
         if self.type in ['RAR', 'RAR5']:
             raise NotImplementedError
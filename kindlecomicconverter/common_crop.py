@@ -1,28 +1,76 @@
+from functools import cached_property
+from PIL import Image, ImageFilter, ImageOps
+import numpy as np
+
+
 def threshold_from_power(power):
     return 240-(power*64)
 
 
 '''
-Groups close values together
+Preprocessed copy of a page shared by the crop detectors.
+
+    Parameters:
+            img (PIL image): A PIL image.
+            background_color (string): 'white' for white background, anything else for black.
+            gray (PIL image): Grayscale (and inverted for black background) page, when already known.
+'''
+class CropAnalysis:
+    def __init__(self, img, background_color='white', gray=None):
+        if gray is None:
+            gray = img
+            if gray.mode != 'L':
+                gray = ImageOps.grayscale(gray)
+            if background_color != 'white':
+                gray = ImageOps.invert(gray)
+        self.source = img
+        self.background_color = background_color
+        self.gray = gray
+
+    @cached_property
+    def image(self):
+        '''
+        Autocontrast: due to some threshold values, it's important that the blacks will be blacks and white will be whites.
+        Box/MeanFilter: Allows us to reduce noise like bad a page scan or compression artifacts.
+        Note: MedianFilter works better in my experience, but takes 2x-3x longer to perform.
+        '''
+        return ImageOps.autocontrast(self.gray, 1).filter(ImageFilter.BoxBlur(1))
+
+    @cached_property
+    def pixels(self):
+        return np.asarray(self.image)
+
+    '''
+    Analysis of the page cropped to 'box'. Grayscale and invert work per pixel, so only
+    autocontrast and blur have to be repeated, when a detector asks for them.
+    '''
+    def crop(self, img, box):
+        return CropAnalysis(img, self.background_color, self.gray.crop(box))
+
+    '''
+    Black and white bitmap, 255 for the pixels that are not background.
+    '''
+    def threshold(self, power):
+        return Image.fromarray(np.where(self.pixels <= threshold_from_power(power), 255, 0).astype(np.uint8))
+
+
+'''
+Groups close values together. A gap ends the group and the value right after it is skipped,
+the next one starts a new group. So in a row of gaps only every other one ends a group.
 '''
 def group_close_values(vals, max_dist_tolerated):
-    groups = []
-
-    group_start = -1
-    group_end = 0
-    for i in range(len(vals)):
-        dist = vals[i] - group_end
-        if group_start == -1:
-            group_start = vals[i]
-            group_end = vals[i]
-        elif dist <= max_dist_tolerated:
-            group_end = vals[i]
-        else:
-            groups.append((group_start, group_end))
-            group_start = -1
-            group_end = -1
-            
-    if group_start != -1:
-        groups.append((group_start, group_end))
-        
-    return groups
+    vals = np.asarray(vals)
+    if len(vals) == 0:
+        return []
+
+    idx = np.arange(1, len(vals))
+    gaps = np.diff(vals) > max_dist_tolerated
+    first_gaps = gaps & ~np.concatenate(([False], gaps[:-1]))
+    first_gap_of_run = np.maximum.accumulate(np.where(first_gaps, idx, 0))
+    breaks = idx[gaps & ((idx - first_gap_of_run) % 2 == 0)]
+
+    starts = np.concatenate(([0], breaks + 1))
+    ends = np.concatenate((breaks - 1, [len(vals) - 1]))
+    if len(breaks) and breaks[-1] == len(vals) - 1:
+        starts, ends = starts[:-1], ends[:-1]
+    return list(zip(vals[starts].tolist(), vals[ends].tolist()))
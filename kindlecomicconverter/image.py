@@ -19,7 +19,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import io
+import math
 import os
+from copy import copy
 import numpy as np
 from pathlib import Path
 from functools import cached_property
@@ -29,7 +31,10 @@ from PIL import Image, ImageOps, ImageFile, ImageChops, ImageDraw
 from .rainbow_artifacts_eraser import erase_rainbow_artifacts
 from .page_number_crop_alg import get_bbox_crop_margin_page_number, get_bbox_crop_margin
 from .inter_panel_crop_alg import crop_empty_inter_panel
-from .shared import get_contain_resolution
+from .common_crop import CropAnalysis
+from .lut import applyTable, blackPointTable, gammaTable, thresholdTable
+from .pagestore import PageRecord
+from .shared import get_contain_resolution, stageTimer
 
 AUTO_CROP_THRESHOLD = 0.015
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -152,7 +157,7 @@ class ProfileData:
 
 
 class ComicPageParser:
-    def __init__(self, source, options):
+    def __init__(self, source, options, data=None):
         Image.MAX_IMAGE_PIXELS = int(2048 * 2048 * 2048 // 4 // 3)
         self.opt = options
         self.source = source
@@ -162,8 +167,16 @@ class ComicPageParser:
         # Detect corruption in source image, let caller catch any exceptions triggered.
         srcImgPath = os.path.join(source[0], source[1])
         # Image.open(srcImgPath).verify()
-        with Image.open(srcImgPath) as im:
-            self.image = im.copy()
+        # streamed archive members arrive as bytes, rendered PDF pages as images,
+        # the file on disk is only a placeholder
+        if isinstance(data, Image.Image):
+            self.image = data
+            self.sourceSize = data.size
+        else:
+            with stageTimer('decode'), Image.open(io.BytesIO(data) if data is not None else srcImgPath) as im:
+                self.sourceSize = im.size
+                self.draftImage(im)
+                self.image = im.copy()
 
         self.page_background_color = self.fillCheck()
         self.fill = self.page_background_color
@@ -174,15 +187,68 @@ class ComicPageParser:
             Image.Resampling = Image
         self.splitCheck()
 
-    def getImageHistogram(self, image):
-        histogram = image.histogram()
-        if histogram[0] == 0:
-            return -1
-        elif histogram[255] == 0:
-            return 1
-        else:
-            return 0
-
+    def draftImage(self, im):
+        # JPEG can be decoded at 1/2, 1/4 or 1/8 of its size, pick the smallest one that still covers
+        # the largest device page after splitting, rotating and cropping
+        if im.format != 'JPEG' or self.opt.webtoon or self.opt.maximizestrips or self.opt.kfx \
+                or self.opt.interpanelcrop:
+            return
+        width, height = im.size
+        scale = 0
+        for target in self.opt.targets or [self.opt]:
+            if target.norotate and target.kindle_azw3 or not all(target.profileData[1]):
+                return
+            scale = max(scale, self.draftScale(width, height, target))
+        if scale < 0.5:
+            im.draft(im.mode, (math.ceil(width * scale), math.ceil(height * scale)))
+
+    def draftScale(self, width, height, opt):
+        # same decisions as splitCheck and resizeImage, cropping can take up to 10% from every side
+        CROP_RATIO = 0.8
+        dstwidth, dstheight = opt.profileData[1]
+        landscape = (width > height) != (dstwidth > dstheight)
+        if opt.hq:
+            dstwidth, dstheight = dstwidth * 1.5, dstheight * 1.5
+        if landscape and width / height > 1.16:
+            scales = [0]
+            BISECT_THRESHOLD = 1.8
+            if opt.splitter != 1 and width / height < BISECT_THRESHOLD:
+                if width > height:
+                    scales.append(max(dstwidth / (width / 2), dstheight / height))
+                else:
+                    scales.append(max(dstwidth / width, dstheight / (height / 2)))
+            if opt.splitter > 0 or (opt.splitter == 0 and width / height >= BISECT_THRESHOLD):
+                if opt.norotate:
+                    scales.append(max(dstwidth * 2 / width, dstheight / height))
+                else:
+                    scales.append(max(dstwidth / height, dstheight / width))
+            return max(scales) / CROP_RATIO
+        return max(dstwidth / width, dstheight / height) / CROP_RATIO
+
+    def splitFor(self, options):
+        """Payload for another device profile, decoding and fill detection are not repeated."""
+        parser = copy(self)
+        parser.opt = options
+        parser.size = options.profileData[1]
+        parser.payload = []
+        parser.splitCheck()
+        return parser.payload
+
+    def getStripsFill(self, black, white):
+        # 5 pixel strips along one axis, the last one is pulled back inside the image and
+        # a too short axis is padded with black in front, like an out of bounds crop would be
+        if len(black) < 5:
+            black = np.concatenate((np.ones(5 - len(black), dtype=bool), black))
+            white = np.concatenate((np.zeros(5 - len(white), dtype=bool), white))
+        starts = np.minimum(np.arange(0, len(black), 5), len(black) - 5)
+        black = np.concatenate(([0], np.cumsum(black)))
+        white = np.concatenate(([0], np.cumsum(white)))
+        hasBlack = black[starts + 5] > black[starts]
+        hasWhite = white[starts + 5] > white[starts]
+        # all white strip counts -1, all black strip counts 1
+        return int(np.count_nonzero(hasBlack & ~hasWhite)) - int(np.count_nonzero(~hasBlack))
+
+    @stageTimer('splitCheck')
     def splitCheck(self):
         width, height = self.image.size
         dstwidth, dstheight = self.size
@@ -242,11 +308,12 @@ class ComicPageParser:
         else:
             self.payload.append(['N', self.source, self.image, self.page_background_color, self.fill])
 
+    @stageTimer('fillCheck')
     def fillCheck(self):
         if False:
             return self.opt.bordersColor
         else:
-            bw = self.image.convert('L').point(lambda x: 0 if x < 128 else 255, '1')
+            bw = applyTable(self.image.convert('L'), thresholdTable(128), '1')
             imageBoxA = bw.getbbox()
             imageBoxB = ImageChops.invert(bw).getbbox()
             if imageBoxA is None or imageBoxB is None:
@@ -262,19 +329,9 @@ class ComicPageParser:
                 elif surfaceW > surfaceB:
                     return 'black'
             else:
-                fill = 0
-                startY = 0
-                while startY < bw.size[1]:
-                    if startY + 5 > bw.size[1]:
-                        startY = bw.size[1] - 5
-                    fill += self.getImageHistogram(bw.crop((0, startY, bw.size[0], startY + 5)))
-                    startY += 5
-                startX = 0
-                while startX < bw.size[0]:
-                    if startX + 5 > bw.size[0]:
-                        startX = bw.size[0] - 5
-                    fill += self.getImageHistogram(bw.crop((startX, 0, startX + 5, bw.size[1])))
-                    startX += 5
+                pixels = np.asarray(bw)
+                fill = self.getStripsFill(~pixels.all(axis=1), pixels.any(axis=1))
+                fill += self.getStripsFill(~pixels.all(axis=0), pixels.any(axis=0))
                 if fill > 0:
                     return 'black'
                 else:
@@ -288,13 +345,25 @@ class ComicPage:
         if self.opt.hq:
             self.size = (int(self.size[0] * 1.5), int(self.size[1] * 1.5))
         self.original_color_mode = image.mode
-        # TODO: color check earlier
-        self.image = image.convert("RGB")
+        # grayscale sources keep a single channel, every step gives the same pixels as on an RGB copy
+        if image.mode in ("L", "1"):
+            self.image = image.convert("L")
+        else:
+            # TODO: color check earlier
+            self.image = image.convert("RGB")
         self.color = self.colorCheck()
         self.colorOutput = self.color and self.opt.forcecolor
+        # a page without color ends up grayscale anyway, only a gamma correction of the RGB channels
+        # would give other pixels than the correction of their luminance, in any of the profiles
+        # that share the page (see retarget)
+        if not self.color and self.image.mode == 'RGB' and \
+                all(self.gammaValue(target) == 1.0 for target in self.opt.targets or [self.opt]):
+            self.image = self.image.convert('L')
         self.page_background_color = page_background_color
         self.fill = fill
         self.rotated = False
+        self.files = []
+        self.analysis = None
         self.orgPath = os.path.join(path[0], path[1])
         self.targetPathStart = os.path.join(path[0], os.path.splitext(path[1])[0])
         if 'N' in mode:
@@ -311,6 +380,19 @@ class ComicPage:
         if not hasattr(Image, 'Resampling'):
             Image.Resampling = Image
 
+    def retarget(self, options, path):
+        """Copy of the page for another device profile, saved into path."""
+        page = copy(self)
+        page.opt = options
+        _, page.size, page.palette, page.gamma = options.profileData
+        if options.hq:
+            page.size = (int(page.size[0] * 1.5), int(page.size[1] * 1.5))
+        page.colorOutput = page.color and options.forcecolor
+        page.files = []
+        page.targetPathStart = os.path.join(path, os.path.basename(self.targetPathStart))
+        return page
+
+    @stageTimer('colorCheck')
     def colorCheck(self):
         if self.original_color_mode in ("L", "1"):
             return False
@@ -320,55 +402,34 @@ class ComicPage:
             return True
         return False
     
+    # Cb and Cr histograms as running totals
+    def chroma_histograms(self, image):
+        return np.cumsum(np.array(image.convert("YCbCr").histogram()).reshape(3, 256)[1:], axis=1)
+
     # cut off pixels from both ends of the histogram to remove jpg compression artifacts
     # for better accuracy, you could split the image in half and analyze each half separately
-    def histograms_cutoff(self, cb_hist, cr_hist, cutoff=(2, 2)):
-        if cutoff == (0, 0):
-            return cb_hist, cr_hist
-
-        for h in cb_hist, cr_hist:
-            # get number of pixels
-            n = sum(h)
-            # remove cutoff% pixels from the low end
-            cut = int(n * cutoff[0] // 100)
-            for lo in range(256):
-                if cut > h[lo]:
-                    cut = cut - h[lo]
-                    h[lo] = 0
-                else:
-                    h[lo] -= cut
-                    cut = 0
-                if cut <= 0:
-                    break
-            # remove cutoff% samples from the high end
-            cut = int(n * cutoff[1] // 100)
-            for hi in range(255, -1, -1):
-                if cut > h[hi]:
-                    cut = cut - h[hi]
-                    h[hi] = 0
-                else:
-                    h[hi] -= cut
-                    cut = 0
-                if cut <= 0:
-                    break
-        return cb_hist, cr_hist
-
-    def color_precision(self, cb_hist_original, cr_hist_original, cutoff, diff_threshold):
-        cb_hist, cr_hist = self.histograms_cutoff(cb_hist_original.copy(), cr_hist_original.copy(), cutoff)
-
-        cb_nonzero = [i for i, e in enumerate(cb_hist) if e]
-        cr_nonzero = [i for i, e in enumerate(cr_hist) if e]
-        cb_spread = cb_nonzero[-1] - cb_nonzero[0]
-        cr_spread = cr_nonzero[-1] - cr_nonzero[0]
+    def histograms_cutoff(self, cumsums, cutoff=(2, 2)):
+        # first and last bin of every histogram that still has pixels after the cut
+        lows, highs = [], []
+        for cumsum in cumsums:
+            n = int(cumsum[-1])
+            lows.append(int(np.searchsorted(cumsum, int(n * cutoff[0] // 100), side='right')))
+            highs.append(int(np.searchsorted(cumsum, n - int(n * cutoff[1] // 100), side='left')))
+        return lows, highs
+
+    def color_precision(self, cumsums, cutoff, diff_threshold):
+        (cb_low, cr_low), (cb_high, cr_high) = self.histograms_cutoff(cumsums, cutoff)
+        cb_spread = cb_high - cb_low
+        cr_spread = cr_high - cr_low
 
         # bias adjustment, don't go lower than 7
         SPREAD_THRESHOLD = 7
         if self.opt.forcecolor:
             if any([
-                cb_nonzero[0] > 128,
-                cr_nonzero[0] > 128,
-                cb_nonzero[-1] < 128,
-                cr_nonzero[-1] < 128,
+                cb_low > 128,
+                cr_low > 128,
+                cb_high < 128,
+                cr_high < 128,
             ]):
                 return True, True
         elif cb_spread < SPREAD_THRESHOLD and cr_spread < SPREAD_THRESHOLD:
@@ -376,24 +437,28 @@ class ComicPage:
 
         DIFF_THRESHOLD = diff_threshold
         if any([
-            cb_nonzero[0] <= 128 - DIFF_THRESHOLD, 
-            cr_nonzero[0] <= 128 - DIFF_THRESHOLD, 
-            cb_nonzero[-1] >= 128 + DIFF_THRESHOLD, 
-            cr_nonzero[-1] >= 128 + DIFF_THRESHOLD,
+            cb_low <= 128 - DIFF_THRESHOLD, 
+            cr_low <= 128 - DIFF_THRESHOLD, 
+            cb_high >= 128 + DIFF_THRESHOLD, 
+            cr_high >= 128 + DIFF_THRESHOLD,
         ]):
             return True, True
         
         return False, None
 
     def calculate_color(self):
-        img = self.image.convert("YCbCr")
-        _, cb, cr = img.split()
-        cb_hist_original = cb.histogram()
-        cr_hist_original = cr.histogram()
+        # averaging only pulls chroma towards neutral, so a thumbnail that is clearly colored (with
+        # some margin for rounding) gives the same answer as the first pass over the whole page
+        MARGIN = 3
+        (cb_low, cr_low), (cb_high, cr_high) = self.histograms_cutoff(self.chroma_histograms(self.image.reduce(4)), (0, 0))
+        if max(cb_high - cb_low, cr_high - cr_low) >= 7 + MARGIN and \
+                (min(cb_low, cr_low) <= 128 - 22 - MARGIN or max(cb_high, cr_high) >= 128 + 22 + MARGIN):
+            return True
 
+        cumsums = self.chroma_histograms(self.image)
         # you can increase 22 but don't increase 10. 4 maybe can go higher
         for cutoff, diff_threshold in [((0, 0), 22), ((.2, .2), 10), ((3, 3), 4)]:
-            done, decision = self.color_precision(cb_hist_original, cr_hist_original, cutoff, diff_threshold)
+            done, decision = self.color_precision(cumsums, cutoff, diff_threshold)
             if done:
                 return decision
         return False
@@ -415,50 +480,75 @@ class ComicPage:
                 targetPath = self.save_with_codec(self.image, self.targetPathStart + self.targetPathOrder)
             if os.path.isfile(self.orgPath):
                 os.remove(self.orgPath)
-            return [Path(targetPath).name, flags]
+            for _, record in self.files:
+                record.flags = flags
+            return [Path(targetPath).name, flags, self.files]
         except IOError as err:
             raise RuntimeError('Cannot save image. ' + str(err))
 
+    @stageTimer('encode')
     def save_with_codec(self, image, targetPath):
+        # in memory mode (and for the page cache) the encoded page is handed back to the main process
+        # instead of the work directory
+        output = io.BytesIO() if self.opt.inmemory or self.opt.cachedir else None
         if self.opt.forcepng and (not self.colorOutput or self.opt.force_png_rgb):
             image.info.pop('transparency', None)
             if self.opt.webp_output:
                 targetPath += '.webp'
-                image.save(targetPath, 'WEBP', lossless=True, quality=self.opt.jpegquality)
+                codec = 'WEBP'
+                image.save(output or targetPath, 'WEBP', lossless=True, quality=self.opt.jpegquality)
             elif self.opt.kindle_azw3:
                 targetPath += '.gif'
-                image.save(targetPath, 'GIF', optimize=1, interlace=False)
+                codec = 'GIF'
+                image.save(output or targetPath, 'GIF', optimize=1, interlace=False)
             else:
                 targetPath += '.png'
-                image.save(targetPath, 'PNG', optimize=1)
+                codec = 'PNG'
+                image.save(output or targetPath, 'PNG', optimize=1)
         else:
             if self.opt.webp_output:
                 targetPath += '.webp'
-                image.save(targetPath, 'WEBP', quality=self.opt.jpegquality)
+                codec = 'WEBP'
+                image.save(output or targetPath, 'WEBP', quality=self.opt.jpegquality)
             elif self.opt.mozjpeg:
                 targetPath += '.jpg'
-                with io.BytesIO() as output:
-                    image.save(output, format="JPEG", optimize=1, quality=self.opt.jpegquality)
-                    input_jpeg_bytes = output.getvalue()
+                codec = 'JPEG'
+                with io.BytesIO() as jpeg:
+                    image.save(jpeg, format="JPEG", optimize=1, quality=self.opt.jpegquality)
+                    input_jpeg_bytes = jpeg.getvalue()
                     output_jpeg_bytes = mozjpeg_lossless_optimization.optimize(input_jpeg_bytes)
-                    with open(targetPath, "wb") as output_jpeg_file:
-                        output_jpeg_file.write(output_jpeg_bytes)
+                    if output:
+                        output.write(output_jpeg_bytes)
+                    else:
+                        with open(targetPath, "wb") as output_jpeg_file:
+                            output_jpeg_file.write(output_jpeg_bytes)
             else:
                 targetPath += '.jpg'
-                image.save(targetPath, 'JPEG', optimize=1, quality=self.opt.jpegquality)
+                codec = 'JPEG'
+                image.save(output or targetPath, 'JPEG', optimize=1, quality=self.opt.jpegquality)
+        # the flags are added by saveToDir
+        self.files.append((output.getvalue() if output else None,
+                           PageRecord(targetPath, image.size, [], self.colorOutput, codec)))
         return targetPath
 
-    def gammaCorrectImage(self):
-        gamma = self.opt.gamma
+    def gammaValue(self, opt=None):
+        opt = opt or self.opt
+        gamma = opt.gamma
         if gamma < 0.1:
-            gamma = self.gamma
-            if self.gamma != 1.0 and self.color:
+            gamma = opt.profileData[3]
+            if gamma != 1.0 and self.color:
                 gamma = 1.0
+        return gamma
+
+    @stageTimer('gamma')
+    def gammaCorrectImage(self):
+        gamma = self.gammaValue()
         if gamma == 1.0:
             pass
         else:
-            self.image = Image.eval(self.image, lambda a: int(255 * (a / 255.) ** gamma))
+            self.image = applyTable(self.image, gammaTable(gamma))
 
+    @stageTimer('autocontrast')
     def autocontrastImage(self):
         if self.opt.webtoon:
             return
@@ -468,7 +558,7 @@ class ComicPage:
             return
 
         # if image is extremely low contrast, that was probably intentional
-        extrema = self.image.convert('L').getextrema()
+        extrema = self.grayscaleImage().getextrema()
         if extrema[1] - extrema[0] < (255 - 32 * 3):
             return
 
@@ -484,20 +574,25 @@ class ComicPage:
             y, cb, cr = img.split()
             img = y
         else:
-            img = img.convert('L')
+            img = self.grayscaleImage()
         h = img.histogram()
         most_common_dark_pixel_count = max(h[:64])
         black_point = h.index(most_common_dark_pixel_count)
-        bp = black_point
-        img = img.point(lambda p: p if p > bp else bp)
+        img = img.point(blackPointTable(black_point))
         if self.color:
             self.image = Image.merge(mode='YCbCr', bands=[img, cb, cr]).convert('RGB')
         else:
             self.image = img
 
+    def grayscaleImage(self):
+        if self.image.mode == 'L':
+            return self.image
+        return self.image.convert('L')
+
     def convertToGrayscale(self):
-        self.image = self.image.convert('L')
+        self.image = self.grayscaleImage()
 
+    @stageTimer('quantize')
     def quantizeImage(self):
         # remove all color pixels from image, since colorCheck() has some tolerance
         # quantize with a small number of color pixels in a mostly b/w image can have unexpected results
@@ -507,11 +602,13 @@ class ComicPage:
         palImg.putpalette(self.palette)
         self.image = self.image.quantize(palette=palImg)
 
+    @stageTimer('rainbowErase')
     def optimizeForDisplay(self, eraserainbow, is_color):
         # Erase rainbow artifacts for grayscale and color images by removing spectral frequencies that cause Moire interference with color filter array
         if eraserainbow and all(dim > 1 for dim in self.image.size):
             self.image = erase_rainbow_artifacts(self.image, is_color)
 
+    @stageTimer('resize')
     def resizeImage(self):
         if self.opt.norotate and self.targetPathOrder in ('-kcc-a', '-kcc-d') and not self.opt.kindle_scribe_azw3:
             # TODO: Kindle Scribe case
@@ -564,9 +661,19 @@ class ComicPage:
         image_area = self.image.size[0] * self.image.size[1]
         if (box_area / image_area) >= minimum:
             self.image = self.image.crop(box)
+            if self.analysis:
+                self.analysis = self.analysis.crop(self.image, box)
+
+    def getCropAnalysis(self):
+        # shared by the crop detectors, it follows the crops made in between
+        if self.analysis is None or self.analysis.source is not self.image:
+            self.analysis = CropAnalysis(self.image, self.page_background_color)
+        return self.analysis
 
+    @stageTimer('crop')
     def cropPageNumber(self, power, minimum):
-        bbox = get_bbox_crop_margin_page_number(self.image, power, self.page_background_color)
+        bbox = get_bbox_crop_margin_page_number(self.image, power, self.page_background_color,
+                                                self.getCropAnalysis())
         
         if bbox:
             w, h = self.image.size
@@ -575,8 +682,9 @@ class ComicPage:
             bbox = (min(0.1*w, left), min(0.1*h, upper), max(0.9*w, right), max(0.9*h, lower))
             self.maybeCrop(bbox, minimum)
 
+    @stageTimer('crop')
     def cropMargin(self, power, minimum):
-        bbox = get_bbox_crop_margin(self.image, power, self.page_background_color)
+        bbox = get_bbox_crop_margin(self.image, power, self.page_background_color, self.getCropAnalysis())
         
         if bbox:
             w, h = self.image.size
@@ -585,14 +693,16 @@ class ComicPage:
             bbox = (min(0.1*w, left), min(0.1*h, upper), max(0.9*w, right), max(0.9*h, lower))
             self.maybeCrop(bbox, minimum)
 
+    @stageTimer('crop')
     def cropInterPanelEmptySections(self, direction):
-        self.image = crop_empty_inter_panel(self.image, direction, background_color=self.page_background_color)
+        self.image = crop_empty_inter_panel(self.image, direction, background_color=self.page_background_color,
+                                            analysis=self.getCropAnalysis())
 
 class Cover:
     def __init__(self, source, opt):
         self.options = opt
         self.source = source
-        self.image = Image.open(source)
+        self.image = source if isinstance(source, Image.Image) else Image.open(source)
         self.smartcover = False
         # backwards compatibility for Pillow >9.1.0
         if not hasattr(Image, 'Resampling'):
@@ -1,7 +1,7 @@
-from PIL import Image, ImageFilter, ImageOps, ImageFile
+from PIL import Image, ImageFile
 import numpy as np
 from typing import Literal
-from .common_crop import threshold_from_power, group_close_values
+from .common_crop import CropAnalysis, group_close_values
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -14,23 +14,18 @@ Crops inter-panel empty spaces (ignores empty spaces near borders - for that use
             direction (horizontal or vertical or both): To crop rows (horizontal), cols (vertical) or both.
             keep (float): Distance to keep between panels after cropping (in percentage relative to the original distance).
             background_color (string): 'white' for white background, anything else for black.
+            analysis (CropAnalysis): Preprocessed page shared with the other detectors, made from 'img' when missing.
     Returns:
             img (PIL image): A PIL image after cropping empty sections.
 '''
-def crop_empty_inter_panel(img, direction: Literal["horizontal", "vertical", "both"], keep=0.04, background_color='white'):
-    img_temp = img
-    
-    if img.mode != 'L':
-        img_temp = ImageOps.grayscale(img_temp)
-        
-    if background_color != 'white':
-        img_temp = ImageOps.invert(img_temp)
+def crop_empty_inter_panel(img, direction: Literal["horizontal", "vertical", "both"], keep=0.04, background_color='white', analysis=None):
+    if analysis is None:
+        analysis = CropAnalysis(img, background_color)
         
     img_mat = np.array(img)
     
     power = 1
-    img_temp = ImageOps.autocontrast(img_temp, 1).filter(ImageFilter.BoxBlur(1))
-    img_temp = img_temp.point(lambda p: 255 if p <= threshold_from_power(power) else 0)
+    img_temp = analysis.threshold(power)
     
     if direction in ["horizontal", "both"]:
         rows_idx_to_remove = empty_sections(img_temp, keep, horizontal=True)
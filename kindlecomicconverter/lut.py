@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014 Ciro Mattia Gonano <ciromattia@gmail.com>
+# Copyright (c) 2013-2019 Pawel Jastrzebski <pawelj@iosphe.re>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all
+# copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+# WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+# DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA
+# OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+#
+
+
+from functools import lru_cache
+
+
+# 256 entry tables for Image.point(), every worker builds each one once and reuses it for the whole book
+
+@lru_cache(maxsize=None)
+def gammaTable(gamma):
+    return [int(255 * (a / 255.) ** gamma) for a in range(256)]
+
+
+@lru_cache(maxsize=None)
+def blackPointTable(blackPoint):
+    return [max(p, blackPoint) for p in range(256)]
+
+
+@lru_cache(maxsize=None)
+def thresholdTable(threshold):
+    return [0 if p < threshold else 255 for p in range(256)]
+
+
+def applyTable(image, table, mode=None):
+    # the same table for every band
+    return image.point(table * len(image.getbands()), mode)
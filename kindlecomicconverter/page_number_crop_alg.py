@@ -1,6 +1,6 @@
-from PIL import ImageOps, ImageFilter, ImageFile
+from PIL import ImageFile
 import numpy as np
-from .common_crop import threshold_from_power, group_close_values
+from .common_crop import CropAnalysis, threshold_from_power, group_close_values
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -31,29 +31,21 @@ that allows us to upscale the image even more.
             img (PIL image): A PIL image.
             power (float): The power to 'chop' through pixels matching the background. Values in range[0,3].
             background_color (string): 'white' for white background, anything else for black.
+            analysis (CropAnalysis): Preprocessed page shared with the other detectors, made from 'img' when missing.
     Returns:
             bbox (4-tuple, left|top|right|bot): The tightest bounding box calculated after trying to remove the bottom page number. Returns None if couldnt find anything satisfactory
 '''
-def get_bbox_crop_margin_page_number(img, power=1, background_color='white'):
-    if img.mode != 'L':
-        img = ImageOps.grayscale(img)
-    
-    if background_color != 'white':
-        img = ImageOps.invert(img)
-        
-    '''
-    Autocontrast: due to some threshold values, it's important that the blacks will be blacks and white will be whites.
-    Box/MeanFilter: Allows us to reduce noise like bad a page scan or compression artifacts.
-    Note: MedianFilter works better in my experience, but takes 2x-3x longer to perform.
-    '''
-    img = ImageOps.autocontrast(img, 1).filter(ImageFilter.BoxBlur(1))
-    
+def get_bbox_crop_margin_page_number(img, power=1, background_color='white', analysis=None):
+    if analysis is None:
+        analysis = CropAnalysis(img, background_color)
+    img = analysis.image
+
     '''
     The 'power' parameters determines the threshold. The higher the power, the more "force" it can crop through black pixels (in case of white background)
     and the lower the power, more sensitive to black pixels. 
     '''
     threshold = threshold_from_power(power)
-    bw_img = img.point(lambda p: 255 if p <= threshold else 0)
+    bw_img = analysis.threshold(power)
     ignore_pixels_near_edge(bw_img)
     bw_bbox = bw_img.getbbox()
     if not bw_bbox: # bbox cannot be found in case that the entire resulted image is black.
@@ -121,29 +113,21 @@ def get_bbox_crop_margin_page_number(img, power=1, background_color='white'):
             img (PIL image): A PIL image.
             power (float): The power to 'chop' through pixels matching the background. Values in range[0,3].
             background_color (string): 'white' for white background, anything else for black.
+            analysis (CropAnalysis): Preprocessed page shared with the other detectors, made from 'img' when missing.
     Returns:
             bbox (4-tuple, left|top|right|bot): The tightest bounding box calculated after trying to remove the bottom page number. Returns None if couldnt find anything satisfactory
 '''
-def get_bbox_crop_margin(img, power=1, background_color='white'):
-    if img.mode != 'L':
-        img = ImageOps.grayscale(img)
-    
-    if background_color != 'white':
-        img = ImageOps.invert(img)
-        
-    '''
-    Autocontrast: due to some threshold values, it's important that the blacks will be blacks and white will be whites.
-    Box/MeanFilter: Allows us to reduce noise like bad a page scan or compression artifacts.
-    Note: MedianFilter works better in my experience, but takes 2x-3x longer to perform.
-    '''
-    img = ImageOps.autocontrast(img, 1).filter(ImageFilter.BoxBlur(1))
-    
+def get_bbox_crop_margin(img, power=1, background_color='white', analysis=None):
+    if analysis is None:
+        analysis = CropAnalysis(img, background_color)
+    img = analysis.image
+
     '''
     The 'power' parameters determines the threshold. The higher the power, the more "force" it can crop through black pixels (in case of white background)
     and the lower the power, more sensitive to black pixels. 
     '''
     threshold = threshold_from_power(power)
-    bw_img = img.point(lambda p: 255 if p <= threshold else 0)
+    bw_img = analysis.threshold(power)
     
     ignore_pixels_near_edge(bw_img)
 
@@ -167,40 +151,54 @@ def ignore_pixels_near_edge(bw_img):
             bw_img.paste(im=0, box=box)
 
 
-def box_intersect(box1, box2, max_dist):
-    return not (box2[0]-max_dist[0] > box1[1]
-        or box2[1]+max_dist[0] < box1[0]
-        or box2[2]-max_dist[1] > box1[3]
-        or box2[3]+max_dist[1] < box1[2])
+'''
+Labels the groups of boxes (left,right, top,bot) that touch each other, directly or through other boxes,
+with distance threshold defined in 'max_dist_tolerated'.
+'''
+def touching_boxes(boxes, max_dist_tolerated):
+    order = np.argsort(boxes[:, 2], kind='stable')
+    sorted_boxes = boxes[order]
+
+    # sorted by top, a box can only touch the following ones that start above its bottom (plus distance)
+    last = np.searchsorted(sorted_boxes[:, 2], sorted_boxes[:, 3] + max_dist_tolerated[1], side='right')
+    counts = np.maximum(last - np.arange(len(boxes)) - 1, 0)
+    first = np.repeat(np.arange(len(boxes)), counts)
+    second = first + 1 + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    touching = ~((sorted_boxes[second, 0] - max_dist_tolerated[0] > sorted_boxes[first, 1])
+                 | (sorted_boxes[second, 1] + max_dist_tolerated[0] < sorted_boxes[first, 0]))
+    first, second = first[touching], second[touching]
+
+    # every box takes the lowest label of its neighbours until nothing changes
+    labels = np.arange(len(boxes))
+    while True:
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, first, labels[second])
+        np.minimum.at(new_labels, second, labels[first])
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+    _, labels[order] = np.unique(labels, return_inverse=True)
+    return labels
 
 '''
 Merge close bounding boxes (left,right, top,bot) (x axis) with distance threshold defined in
 'max_dist_tolerated'. Boxes with less 'max_dist_tolerated' distance (Chebyshev distance).
+A merged box can reach boxes that none of its parts did, so merging repeats until nothing touches.
 '''
 def merge_boxes(boxes, max_dist_tolerated):
-    j = 0
-    while j < len(boxes)-1:
-        g1 = boxes[j]
-        intersecting_boxes = []
-        other_boxes = []
-        for i in range(j+1,len(boxes)):
-            g2 = boxes[i]
-            if box_intersect(g1,g2, max_dist_tolerated):
-                intersecting_boxes.append(g2)
-            else:
-                other_boxes.append(g2)
-        
-        if len(intersecting_boxes) > 0:
-            intersecting_boxes = np.array([g1, *intersecting_boxes])
-            merged_box = np.array([
-                np.min(intersecting_boxes[:,0]), 
-                np.max(intersecting_boxes[:,1]),
-                np.min(intersecting_boxes[:,2]), 
-                np.max(intersecting_boxes[:,3])
-            ])
-            other_boxes.append(merged_box)
-            boxes = np.concatenate([boxes[:j], other_boxes])
-            j = 0
-        else:
-            j += 1
+    while len(boxes) > 1:
+        labels = touching_boxes(boxes, max_dist_tolerated)
+        if labels.max() + 1 == len(boxes):
+            break
+        order = np.argsort(labels, kind='stable')
+        starts = np.flatnonzero(np.diff(labels[order], prepend=-1))
+        grouped = boxes[order]
+        boxes = np.stack([
+            np.minimum.reduceat(grouped[:, 0], starts),
+            np.maximum.reduceat(grouped[:, 1], starts),
+            np.minimum.reduceat(grouped[:, 2], starts),
+            np.maximum.reduceat(grouped[:, 3], starts)
+        ], axis=1)
     return boxes
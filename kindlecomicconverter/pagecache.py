@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014 Ciro Mattia Gonano <ciromattia@gmail.com>
+# Copyright (c) 2013-2019 Pawel Jastrzebski <pawelj@iosphe.re>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all
+# copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+# WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+# DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA
+# OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+#
+
+
+import os
+import json
+import struct
+from hashlib import sha256
+from tempfile import mkstemp
+from PIL import __version__ as pillow_version
+from . import __version__
+
+# options the workers read while processing a page, a new one has to be added here
+PAGE_OPTIONS = ('autolevel', 'bordersColor', 'colorautocontrast', 'cropping', 'croppingm', 'croppingp', 'eraserainbow',
+                'force_png_rgb', 'forcecolor', 'forcepng', 'format', 'gamma', 'hq', 'interpanelcrop', 'jpegquality',
+                'kfx', 'kfx_resolution', 'kindle_azw3', 'kindle_scribe_azw3', 'maximizestrips', 'mozjpeg',
+                'noautocontrast', 'noquantize', 'norotate', 'pnglegacy', 'preservemargin', 'profile', 'profileData',
+                'righttoleft', 'rotatefirst', 'rotateright', 'splitter', 'stretch', 'upscale', 'webp_output', 'webtoon',
+                'white_borders')
+
+# layout of the stored pages, entries of another layout are never hit
+CACHE_FORMAT = 4
+CACHE_MAGIC = b'KCCP'
+# magic and the length of the JSON header, the encoded files follow the header
+CACHE_HEADER = struct.Struct('<4sI')
+
+
+class PageCache:
+    """Encoded pages of earlier conversions, stored as one file per source page.
+
+    The key is a hash of the source image bytes and of every option that can change the
+    output. An entry is a JSON header with the names, flags and sizes of the pages followed
+    by the encoded files as they are, nothing in it is ever executed. Hits refresh the file
+    time, trim() drops the least recently used entries once the directory grows past the limit.
+    """
+    def __init__(self, directory, limit=0):
+        self.directory = directory
+        self.limit = limit
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def settings(options):
+        settings = [(k, getattr(options, k, None)) for k in PAGE_OPTIONS]
+        return repr((CACHE_FORMAT, __version__, pillow_version, settings)).encode()
+
+    @staticmethod
+    def key(settings, data):
+        return sha256(settings + sha256(data).digest()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                pages = self.load(f.read())
+            os.utime(path)
+            return pages
+        except Exception:
+            # missing or damaged entry, the page is processed (and stored) again
+            return None
+
+    def put(self, key, pages):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = mkstemp('.tmp', '', os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self.dump(f, pages)
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    @staticmethod
+    def dump(f, pages):
+        header = [[name, flags, [[suffix, len(data), list(size), color, codec]
+                                 for suffix, data, size, color, codec in files]]
+                  for name, flags, files in pages]
+        header = json.dumps(header).encode()
+        f.write(CACHE_HEADER.pack(CACHE_MAGIC, len(header)))
+        f.write(header)
+        for _, _, files in pages:
+            for _, data, _, _, _ in files:
+                f.write(data)
+
+    @staticmethod
+    def load(entry):
+        magic, length = CACHE_HEADER.unpack_from(entry)
+        if magic != CACHE_MAGIC:
+            raise ValueError('Not a page cache entry.')
+        offset = CACHE_HEADER.size + length
+        pages = []
+        for name, flags, files in json.loads(entry[CACHE_HEADER.size:offset]):
+            restored = []
+            for suffix, size, (width, height), color, codec in files:
+                if offset + size > len(entry):
+                    raise ValueError('Truncated page cache entry.')
+                restored.append((str(suffix), entry[offset:offset + size], (int(width), int(height)), bool(color),
+                                 str(codec)))
+                offset += size
+            pages.append([str(name), [str(flag) for flag in flags], restored])
+        return pages
+
+    def trim(self):
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.limit:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
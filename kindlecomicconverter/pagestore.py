@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014 Ciro Mattia Gonano <ciromattia@gmail.com>
+# Copyright (c) 2013-2019 Pawel Jastrzebski <pawelj@iosphe.re>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all
+# copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+# WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+# DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA
+# OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+#
+
+import io
+import os
+from shutil import move
+
+
+class PageRecord:
+    """What is known about one image of the work directory without opening it.
+
+    Filled in by the workers for the processed pages and by the source checks for
+    the source images. width and height make it usable where only an image size is read.
+    """
+    __slots__ = ('path', 'size', 'flags', 'color', 'codec')
+
+    def __init__(self, path, size, flags, color, codec):
+        self.path = path
+        self.size = size
+        self.flags = flags
+        self.color = color
+        self.codec = codec
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+
+class PageStore:
+    """Encoded page images keyed by their path in the work directory.
+
+    Pages stay in memory until the budget is used up, after that they are written
+    to their path like before. Directories always live on disk, so the tree layout
+    (chapters, tomes) keeps working with the usual os functions. The PageRecord of
+    every known image is kept as well, wherever its data is.
+    """
+    def __init__(self, budget=0):
+        self.budget = budget
+        self.used = 0
+        self.pages = {}
+        self.records = {}
+
+    def put(self, path, data):
+        path = os.path.normpath(path)
+        if self.used + len(data) > self.budget:
+            with open(path, 'wb') as f:
+                f.write(data)
+        else:
+            self.pages[path] = data
+            self.used += len(data)
+
+    def get(self, path):
+        path = os.path.normpath(path)
+        if path in self.pages:
+            return self.pages[path]
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def open(self, path):
+        path = os.path.normpath(path)
+        if path in self.pages:
+            return io.BytesIO(self.pages[path])
+        return open(path, 'rb')
+
+    def setrecord(self, record):
+        record.path = os.path.normpath(record.path)
+        self.records[record.path] = record
+
+    def getrecord(self, path):
+        return self.records.get(os.path.normpath(path))
+
+    def getsize(self, path):
+        path = os.path.normpath(path)
+        if path in self.pages:
+            return len(self.pages[path])
+        return os.path.getsize(path)
+
+    def isfile(self, path):
+        return os.path.normpath(path) in self.pages or os.path.isfile(path)
+
+    def inmemory(self, path):
+        return os.path.normpath(path) in self.pages
+
+    def contains(self, top):
+        top = os.path.normpath(top) + os.sep
+        return any(path.startswith(top) for path in self.pages)
+
+    def listdir(self, root):
+        root = os.path.normpath(root)
+        return [os.path.basename(path) for path in self.pages if os.path.dirname(path) == root]
+
+    def walk(self, top, topdown=True):
+        for root, dirs, files in os.walk(top, topdown):
+            stored = self.listdir(root)
+            if stored:
+                files = sorted(set(files).union(stored))
+            yield root, dirs, files
+
+    def rekey(self, src, dst):
+        # pages and records of the file or directory src now belong to dst, directories only exist on disk
+        for store in (self.pages, self.records):
+            paths = [src] if src in store else []
+            if os.path.isdir(src):
+                paths = [path for path in store if path.startswith(src + os.sep)]
+            for path in paths:
+                item = store[dst + path[len(src):]] = store.pop(path)
+                if store is self.records:
+                    item.path = dst + path[len(src):]
+
+    def move(self, src, dst):
+        src = os.path.normpath(src)
+        dst = os.path.normpath(dst)
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        inmemory = src in self.pages
+        self.rekey(src, dst)
+        if not inmemory:
+            move(src, dst)
+
+    def replace(self, src, dst):
+        src = os.path.normpath(src)
+        dst = os.path.normpath(dst)
+        self.rekey(src, dst)
+        os.replace(src, dst)
+
+    def remove(self, path):
+        path = os.path.normpath(path)
+        self.records.pop(path, None)
+        if path in self.pages:
+            self.used -= len(self.pages.pop(path))
+        else:
+            os.remove(path)
+
+    def discard(self, top):
+        top = os.path.normpath(top) + os.sep
+        for path in [path for path in self.pages if path.startswith(top)]:
+            self.used -= len(self.pages.pop(path))
+        for path in [path for path in self.records if path.startswith(top)]:
+            del self.records[path]
+
+    def clear(self):
+        self.pages = {}
+        self.records = {}
+        self.used = 0
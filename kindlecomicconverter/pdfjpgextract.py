@@ -21,13 +21,345 @@
 # PERFORMANCE OF THIS SOFTWARE.
 #
 
+import mmap
 import os
+import re
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 # skip stray images a few pixels in size in some PDFs
 # typical images are many thousands in length
 # https://github.com/ciromattia/kcc/pull/546
 STRAY_IMAGE_LENGTH_THRESHOLD = 300
 
+WHITESPACE = rb'(?:[\x00\t\n\x0c\r ]|%[^\r\n]*)*'
+REGULAR = rb'[^\x00\t\n\x0c\r ()<>\[\]{}/%]'
+TOKEN = re.compile(WHITESPACE + rb'(<<|>>|[\[\]{}()]|<[^<>]*>|/' + REGULAR + rb'*|' + REGULAR + rb'+)')
+REFERENCE = re.compile(WHITESPACE + rb'(\d+)' + WHITESPACE + rb'R(?!' + REGULAR + rb')')
+STRING_DELIMITER = re.compile(rb'\\.|[()]', re.S)
+NUMBER = re.compile(rb'[+-]?(?:\d+\.?\d*|\.\d+)')
+OBJECT_HEADER = re.compile(rb'(\d+)\s+(\d+)\s+obj\b')
+OBJECT_AT = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj\b')
+STREAM = re.compile(rb'\s*stream(?:\r\n|\n|\r)')
+ENDSTREAM = re.compile(rb'\s*endstream')
+STARTXREF = re.compile(rb'startxref\s+(\d+)')
+XREF_SECTION = re.compile(rb'\s*(\d+)\s+(\d+)')
+XREF_ENTRY = re.compile(rb'\s*(\d+)\s+(\d+)\s+([nf])')
+KEYWORDS = {b'true': True, b'false': False, b'null': None}
+
+# object number of an indirect reference, 12 0 R
+Reference = namedtuple('Reference', 'number')
+# offset of the object in the file, or the object stream it is compressed in
+XrefEntry = namedtuple('XrefEntry', 'offset stream')
+
+
+def parseObject(data, pos):
+    """
+    Parses the PDF object at pos of data.
+
+    Names are returned as str, strings as raw bytes and indirect references as Reference.
+
+    Returns:
+        (object, position after the object)
+    """
+    match = TOKEN.match(data, pos)
+    if not match:
+        raise ValueError('Unexpected end of PDF object')
+    token, pos = match.group(1), match.end()
+    if token == b'<<':
+        result = {}
+        while True:
+            match = TOKEN.match(data, pos)
+            if match and match.group(1) == b'>>':
+                return result, match.end()
+            key, pos = parseObject(data, pos)
+            result[key], pos = parseObject(data, pos)
+    if token == b'[':
+        result = []
+        while True:
+            match = TOKEN.match(data, pos)
+            if match and match.group(1) == b']':
+                return result, match.end()
+            value, pos = parseObject(data, pos)
+            result.append(value)
+    if token == b'(':
+        start, depth = pos, 1
+        while depth:
+            match = STRING_DELIMITER.search(data, pos)
+            if not match:
+                raise ValueError('Unterminated PDF string')
+            pos = match.end()
+            depth += {b'(': 1, b')': -1}.get(match.group(), 0)
+        return bytes(data[start:pos - 1]), pos
+    if token.startswith(b'/'):
+        return token[1:].decode('latin-1'), pos
+    if token.startswith(b'<'):
+        return token[1:-1], pos
+    if NUMBER.fullmatch(token):
+        if b'.' in token:
+            return float(token), pos
+        match = REFERENCE.match(data, pos)
+        if match:
+            return Reference(int(token)), match.end()
+        return int(token), pos
+    if token in KEYWORDS:
+        return KEYWORDS[token], pos
+    raise ValueError(f'Unexpected PDF token {token!r}')
+
+
+def unpredict(data, columns):
+    # PNG predictors of xref streams, a filter type byte before every row of bytes
+    rows, previous = [], bytearray(columns)
+    for start in range(0, len(data) - columns, columns + 1):
+        kind, row = data[start], bytearray(data[start + 1:start + 1 + columns])
+        if kind == 1:
+            for i in range(1, columns):
+                row[i] = (row[i] + row[i - 1]) & 0xff
+        elif kind == 2:
+            row = bytearray((a + b) & 0xff for a, b in zip(row, previous))
+        elif kind != 0:
+            raise ValueError(f'Unsupported PNG predictor {kind}')
+        rows.append(row)
+        previous = row
+    return b''.join(rows)
+
+
+class PdfFile:
+    """
+    Object lookup of a PDF on a buffer, only the parts needed to find the JPEG images of the pages.
+
+    Objects are found with the cross-reference table or streams. When those are damaged, the
+    table is rebuilt from the "N G obj" headers of the whole file.
+    """
+    def __init__(self, pdf):
+        self.pdf = pdf
+        self.xref = {}
+        self.trailer = {}
+        self.streams = {}
+
+    def readXref(self):
+        start = self.pdf.rfind(b'startxref', max(0, len(self.pdf) - 4096))
+        match = STARTXREF.match(self.pdf, start) if start >= 0 else None
+        if not match:
+            raise ValueError('startxref is missing')
+        # the newest section first, its entries replace the ones of the older sections
+        pos, seen = int(match.group(1)), set()
+        while isinstance(pos, int) and pos not in seen:
+            seen.add(pos)
+            if self.pdf[pos:pos + 4] == b'xref':
+                trailer = self.readXrefTable(pos + 4)
+                # hybrid files, the compressed objects are only in the stream
+                if isinstance(trailer.get('XRefStm'), int):
+                    self.readXrefStream(trailer['XRefStm'])
+            else:
+                trailer = self.readXrefStream(pos)
+            for key, value in trailer.items():
+                self.trailer.setdefault(key, value)
+            pos = trailer.get('Prev')
+        if 'Root' not in self.trailer:
+            raise ValueError('Trailer without Root')
+
+    def readXrefTable(self, pos):
+        while True:
+            section = XREF_SECTION.match(self.pdf, pos)
+            if not section:
+                break
+            pos = section.end()
+            first, count = int(section.group(1)), int(section.group(2))
+            for number in range(first, first + count):
+                entry = XREF_ENTRY.match(self.pdf, pos)
+                if not entry:
+                    raise ValueError('Damaged xref table')
+                pos = entry.end()
+                if entry.group(3) == b'n':
+                    self.xref.setdefault(number, XrefEntry(int(entry.group(1)), None))
+        match = TOKEN.match(self.pdf, pos)
+        if not match or match.group(1) != b'trailer':
+            raise ValueError('Trailer is missing')
+        return parseObject(self.pdf, match.end())[0]
+
+    def readXrefStream(self, pos):
+        dictionary, end = self.readObjectAt(pos)
+        data = self.decodeStream(dictionary, *self.streamRange(dictionary, end))
+        widths = dictionary['W']
+        index = dictionary.get('Index', [0, dictionary['Size']])
+        pos = 0
+        for first, count in zip(index[::2], index[1::2]):
+            for number in range(first, first + count):
+                fields = []
+                for width in widths:
+                    fields.append(int.from_bytes(data[pos:pos + width], 'big'))
+                    pos += width
+                kind = fields[0] if widths[0] else 1
+                if kind == 1:
+                    self.xref.setdefault(number, XrefEntry(fields[1], None))
+                elif kind == 2:
+                    self.xref.setdefault(number, XrefEntry(None, fields[1]))
+        return dictionary
+
+    def scanObjects(self):
+        self.xref, self.trailer, self.streams = {}, {}, {}
+        # later definitions win, like the updates appended to a file
+        for match in OBJECT_HEADER.finditer(self.pdf):
+            self.xref[int(match.group(1))] = XrefEntry(match.start(), None)
+        for number in list(self.xref):
+            try:
+                dictionary = self.getObject(number)[0]
+                if not isinstance(dictionary, dict):
+                    continue
+                if dictionary.get('Type') == 'ObjStm':
+                    for compressed in self.objectStream(number)[1]:
+                        self.xref.setdefault(compressed, XrefEntry(None, number))
+                elif dictionary.get('Type') == 'Catalog':
+                    self.trailer['Root'] = Reference(number)
+            except Exception:
+                continue
+
+    def readObjectAt(self, pos):
+        match = OBJECT_AT.match(self.pdf, pos)
+        if not match:
+            raise ValueError(f'No object at {pos}')
+        return parseObject(self.pdf, match.end())
+
+    def getObject(self, number):
+        """
+        Returns:
+            (object, position after it), the position is None for the objects of object streams
+        """
+        entry = self.xref.get(number)
+        if entry is None:
+            # free and missing objects are null
+            return None, None
+        if entry.offset is not None:
+            return self.readObjectAt(entry.offset)
+        data, offsets = self.objectStream(entry.stream)
+        return parseObject(data, offsets[number])[0], None
+
+    def resolve(self, value):
+        for _ in range(32):
+            if not isinstance(value, Reference):
+                return value
+            value = self.getObject(value.number)[0]
+        raise ValueError('Reference loop')
+
+    def objectStream(self, number):
+        if number not in self.streams:
+            dictionary, end = self.getObject(number)
+            data = self.decodeStream(dictionary, *self.streamRange(dictionary, end))
+            first = self.resolve(dictionary['First'])
+            header = [int(value) for value in data[:first].split()]
+            self.streams[number] = data, {header[i]: first + header[i + 1] for i in range(0, len(header) - 1, 2)}
+        return self.streams[number]
+
+    def streamRange(self, dictionary, end):
+        """Start and end of the data of the stream whose dictionary ends at end."""
+        match = STREAM.match(self.pdf, end) if end is not None else None
+        if not match:
+            raise ValueError('Not a stream')
+        start = match.end()
+        length = self.resolve(dictionary.get('Length'))
+        if isinstance(length, int) and ENDSTREAM.match(self.pdf, start + length):
+            return start, start + length
+        # wrong Length, the data ends before endstream
+        stop = self.pdf.find(b'endstream', start)
+        if stop < 0:
+            raise ValueError("Didn't find end of stream!")
+        while stop > start and self.pdf[stop - 1] in b'\r\n':
+            stop -= 1
+        return start, stop
+
+    def decodeStream(self, dictionary, start, stop):
+        data = self.pdf[start:stop]
+        filters = self.resolve(dictionary.get('Filter'))
+        parameters = self.resolve(dictionary.get('DecodeParms'))
+        if isinstance(filters, list):
+            if len(filters) > 1:
+                raise ValueError(f'Unsupported filters {filters}')
+            filters = filters[0] if filters else None
+            parameters = parameters[0] if isinstance(parameters, list) and parameters else None
+        if filters is None:
+            return data
+        if filters != 'FlateDecode':
+            raise ValueError(f'Unsupported filter {filters}')
+        data = zlib.decompressobj().decompress(data)
+        predictor = parameters.get('Predictor', 1) if isinstance(parameters, dict) else 1
+        if predictor >= 10:
+            return unpredict(data, parameters.get('Columns', 1))
+        if predictor != 1:
+            raise ValueError(f'Unsupported predictor {predictor}')
+        return data
+
+    def pageImages(self):
+        """Object numbers of the images of the page tree, in page order. Every image is listed once."""
+        images = []
+        self.walkPages(self.resolve(self.trailer['Root'])['Pages'], None, images, set())
+        return images
+
+    def walkPages(self, node, resources, images, visited):
+        if isinstance(node, Reference):
+            if node.number in visited:
+                return
+            visited.add(node.number)
+        node = self.resolve(node)
+        # resources are inherited from the parent nodes
+        resources = node.get('Resources', resources)
+        if 'Kids' in node:
+            for kid in self.resolve(node['Kids']):
+                self.walkPages(kid, resources, images, visited)
+        else:
+            self.collectImages(resources, images, visited)
+
+    def collectImages(self, resources, images, visited):
+        resources = self.resolve(resources)
+        xobjects = self.resolve(resources.get('XObject')) if isinstance(resources, dict) else None
+        if not isinstance(xobjects, dict):
+            return
+        for xobject in xobjects.values():
+            if not isinstance(xobject, Reference) or xobject.number in visited:
+                continue
+            visited.add(xobject.number)
+            dictionary = self.resolve(xobject)
+            if not isinstance(dictionary, dict):
+                continue
+            if dictionary.get('Subtype') == 'Image':
+                images.append(xobject.number)
+            elif dictionary.get('Subtype') == 'Form':
+                self.collectImages(dictionary.get('Resources'), images, visited)
+
+    def jpegRange(self, number):
+        """Start and end of the data of a JPEG image object, None for the other objects."""
+        image, end = self.getObject(number)
+        if not isinstance(image, dict) or end is None or image.get('Subtype') != 'Image':
+            return None
+        if self.resolve(image.get('Filter')) not in ('DCTDecode', ['DCTDecode']):
+            return None
+        start, stop = self.streamRange(image, end)
+        if stop - start < STRAY_IMAGE_LENGTH_THRESHOLD or self.pdf[start:start + 2] != b'\xff\xd8':
+            return None
+        return start, stop
+
+    def jpegImages(self):
+        """Start and end of every JPEG image, in page order when the page tree can be read."""
+        for read in (self.readXref, self.scanObjects):
+            try:
+                read()
+                images = [self.jpegRange(number) for number in self.pageImages()]
+            except Exception:
+                # damaged or unusual PDF
+                continue
+            images = [image for image in images if image]
+            if images:
+                return images
+        # no usable page tree, the images in file order
+        images = []
+        for number, entry in sorted(self.xref.items(), key=lambda item: item[1].offset or 0):
+            try:
+                images.append(self.jpegRange(number))
+            except Exception:
+                continue
+        return [image for image in images if image]
+
 
 class PdfJpgExtract:
     def __init__(self, fname, fullPath):
@@ -38,38 +370,20 @@ class PdfJpgExtract:
         return self.path
 
     def extract(self):
-        pdf = open(self.fname, "rb").read()
-        startmark = b"\xff\xd8"
-        startfix = 0
-        endmark = b"\xff\xd9"
-        endfix = 2
-        i = 0
-        njpg = 0
-        while True:
-            istream = pdf.find(b"stream", i)
-            if istream < 0:
-                break
-            istart = pdf.find(startmark, istream, istream + 20)
-            if istart < 0:
-                i = istream + 20
-                continue
-            iend = pdf.find(b"endstream", istart)
-            if iend < 0:
-                raise Exception("Didn't find end of stream!")
-            iend = pdf.find(endmark, iend - 20)
-            if iend < 0:
-                raise Exception("Didn't find end of JPG!")
-            istart += startfix
-            iend += endfix
-            i = iend
-
-            if iend - istart < STRAY_IMAGE_LENGTH_THRESHOLD:
-                continue
+        with open(self.fname, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return 0
+            # the file is paged in as needed and every image is written from a slice of the map, without copies
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as pdf:
+                images = PdfFile(pdf).jpegImages()
+                with memoryview(pdf) as view:
 
-            jpg = pdf[istart:iend]
-            jpgfile = open(os.path.join(self.path, "jpg%d.jpg" % njpg), "wb")
-            jpgfile.write(jpg)
-            jpgfile.close()
-            njpg += 1
+                    def write(number):
+                        start, stop = images[number]
+                        with open(os.path.join(self.path, "jpg%d.jpg" % number), "wb") as jpgfile:
+                            jpgfile.write(view[start:stop])
 
-        return njpg
+                    with ThreadPoolExecutor() as pool:
+                        for _ in pool.map(write, range(len(images))):
+                            pass
+        return len(images)
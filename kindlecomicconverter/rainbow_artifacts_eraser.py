@@ -1,249 +1,332 @@
-import numpy as np
-from PIL import Image, ImageFile
-
-ImageFile.LOAD_TRUNCATED_IMAGES = True
-
-       
-def fourier_transform_image(img):
-    """
-    Memory-optimized version that modifies the array in place when possible.
-    """
-    # Convert with minimal copy
-    img_array = np.asarray(img, dtype=np.float32)
-    
-    # Use rfft2 if the image is real to save memory
-    # and computation time (approximately 2x faster)
-    fft_result = np.fft.rfft2(img_array)
-    
-    return fft_result
-     
-def attenuate_diagonal_frequencies(fft_spectrum, freq_threshold=0.30, target_angle=135, 
-                                     angle_tolerance=10, attenuation_factor=0.10):
-    """
-    Attenuates specific frequencies in the Fourier domain (optimized version for rfft2).
-    
-    Args:
-        fft_spectrum: Result of 2D real Fourier transform (from rfft2)
-        freq_threshold: Frequency threshold in cycles/pixel (default: 0.3, theoretical max: 0.5)
-        target_angle: Target angle in degrees (default: 135)
-        angle_tolerance: Angular tolerance in degrees (default: 15)
-        attenuation_factor: Attenuation factor (0.1 = 90% attenuation)
-    
-    Returns:
-        np.ndarray: Modified FFT with applied attenuation (same format as input)
-    """
-    
-    # Get dimensions of the rfft2 result
-    if fft_spectrum.ndim == 2:
-        height, width_rfft = fft_spectrum.shape
-    else:  # 3D array (color channels)
-        height, width_rfft = fft_spectrum.shape[:2]
-    
-    # For rfft2, the original width is (width_rfft - 1) * 2
-    width_original = (width_rfft - 1) * 2
-    
-    # Create frequency grids for rfft2 format
-    freq_y = np.fft.fftfreq(height, d=1.0)
-    freq_x = np.fft.rfftfreq(width_original, d=1.0)  # Use rfftfreq for the X dimension
-    
-    
-    # Use broadcasting to create grids without meshgrid (more efficient)
-    freq_y_grid = freq_y.reshape(-1, 1)  # Column
-    freq_x_grid = freq_x.reshape(1, -1)   # Row
-    
-    # Calculate squared radial frequencies (avoid sqrt)
-    freq_radial_sq = freq_x_grid**2 + freq_y_grid**2
-    freq_threshold_sq = freq_threshold**2
-    
-    # Frequency condition
-    freq_condition = freq_radial_sq >= freq_threshold_sq
-    
-    # Early exit if no frequency satisfies the condition
-    if not np.any(freq_condition):
-        return fft_spectrum
-    
-    # Calculate angles only where necessary
-    # Use atan2 directly with broadcasting
-    angles_rad = np.arctan2(freq_y_grid, freq_x_grid)
-    
-    # Convert to degrees and normalize in a single operation
-    angles_deg = np.rad2deg(angles_rad) % 360
-    
-    # Calculation of complementary angle
-    target_angle_2 = (target_angle + 180) % 360
-    
-    # Calulation of perpendicular angles (135° + 45° to maximize compatibility until we know for sure which angle configure for each device)
-    target_angle_3 = (target_angle + 90) % 360
-    target_angle_4 = (target_angle_3 + 180) % 360
-    
-    # Create angular conditions in a vectorized way
-    angle_condition = np.zeros_like(angles_deg, dtype=bool)
-    
-    # Process both angles simultaneously
-    for angle in [target_angle, target_angle_2, target_angle_3, target_angle_4]:
-        min_angle = (angle - angle_tolerance) % 360
-        max_angle = (angle + angle_tolerance) % 360
-        
-        if min_angle > max_angle:  # Interval crosses 0°
-            angle_condition |= (angles_deg >= min_angle) | (angles_deg <= max_angle)
-        else:  # Normal interval
-            angle_condition |= (angles_deg >= min_angle) & (angles_deg <= max_angle)
-    
-    # Combine conditions
-    combined_condition = freq_condition & angle_condition
-    
-    # Apply attenuation directly (avoid creating a full mask)
-    if attenuation_factor == 0:
-        # Special case: complete suppression
-        if fft_spectrum.ndim == 2:
-            fft_spectrum[combined_condition] = 0
-        else:  # 3D array
-            fft_spectrum[combined_condition, :] = 0
-        return fft_spectrum
-    elif attenuation_factor == 1:
-        # Special case: no attenuation
-        return fft_spectrum
-    else:
-        # General case: partial attenuation
-        if fft_spectrum.ndim == 2:
-            fft_spectrum[combined_condition] *= attenuation_factor
-        else:  # 3D array
-            fft_spectrum[combined_condition, :] *= attenuation_factor
-        return fft_spectrum
-    
-def inverse_fourier_transform_image(fft_spectrum, is_color, original_shape=None):
-    """
-    Performs an optimized inverse Fourier transform to reconstruct a PIL image.
-    
-    Args:
-        fft_spectrum: Fourier transform result (complex array from rfft2)
-        is_color: Boolean indicating if the image is to be treated as color
-    
-    Returns:
-        PIL.Image: Reconstructed image
-    """    
-    # Perform inverse Fourier transform with original shape if provided
-    if original_shape is not None:
-        img_reconstructed = np.fft.irfft2(fft_spectrum, s=original_shape)
-    else:
-        img_reconstructed = np.fft.irfft2(fft_spectrum)
-    
-    # Normalize values between 0 and 255
-    img_reconstructed = np.clip(img_reconstructed, 0, 255)
-    img_reconstructed = img_reconstructed.astype(np.uint8)
-    
-    # Convert to PIL image
-    if is_color and img_reconstructed.ndim == 3:
-        pil_image = Image.fromarray(img_reconstructed, mode='RGB')
-    else:
-        pil_image = Image.fromarray(img_reconstructed, mode='L')
-    
-    return pil_image
-
-def rgb_to_yuv(rgb_array):
-    """
-    Convert RGB to YUV color space.
-    Y = luminance, U and V = chrominance
-    """
-    # Coefficients for RGB to YUV conversion
-    rgb_to_yuv_matrix = np.array([
-        [0.299, 0.587, 0.114],      # Y
-        [-0.14713, -0.28886, 0.436],  # U
-        [0.615, -0.51499, -0.10001]   # V
-    ])
-    
-    # Reshape for matrix multiplication
-    original_shape = rgb_array.shape
-    rgb_flat = rgb_array.reshape(-1, 3)
-    
-    # Apply transformation
-    yuv_flat = rgb_flat @ rgb_to_yuv_matrix.T
-    
-    # Reshape back
-    yuv_array = yuv_flat.reshape(original_shape)
-    
-    return yuv_array
-
-def yuv_to_rgb(yuv_array):
-    """
-    Convert YUV to RGB color space.
-    """
-    # Coefficients for YUV to RGB conversion
-    yuv_to_rgb_matrix = np.array([
-        [1.0, 0.0, 1.13983],         # R
-        [1.0, -0.39465, -0.58060],   # G
-        [1.0, 2.03211, 0.0]          # B
-    ])
-    
-    # Reshape for matrix multiplication
-    original_shape = yuv_array.shape
-    yuv_flat = yuv_array.reshape(-1, 3)
-    
-    # Apply transformation
-    rgb_flat = yuv_flat @ yuv_to_rgb_matrix.T
-    
-    # Reshape back
-    rgb_array = rgb_flat.reshape(original_shape)
-    
-    return rgb_array
-
-def erase_rainbow_artifacts(img, is_color):
-    """
-    Remove rainbow artifacts from grayscale or color images.
-    
-    Args:
-        img: PIL Image (grayscale or RGB)
-        is_color: Boolean indicating if the image is to be treated as color
-    
-    Returns:
-        PIL.Image: Cleaned image
-    """
-    # Auto-detect color mode if not specified
-    if is_color is None:
-        color = img.mode in ('RGB', 'RGBA', 'L') and len(np.array(img).shape) == 3
-    
-    if is_color and img.mode in ('RGB', 'RGBA'):
-        # Convert to RGB if needed
-        if img.mode == 'RGBA':
-            img = img.convert('RGB')
-        
-        # Convert to numpy array
-        img_array = np.array(img, dtype=np.float32)
-        
-        # Convert to YUV color space
-        yuv_array = rgb_to_yuv(img_array)
-        
-        # Extract luminance channel (Y)
-        luminance = yuv_array[:, :, 0]
-        
-        # Process only the luminance channel
-        fft_spectrum = fourier_transform_image(luminance)
-        clean_spectrum = attenuate_diagonal_frequencies(fft_spectrum)
-        clean_luminance = np.fft.irfft2(clean_spectrum, s=luminance.shape)
-        
-        # Normalize and clip luminance
-        clean_luminance = np.clip(clean_luminance, 0, 255)
-        
-        # Replace luminance in YUV array
-        yuv_array[:, :, 0] = clean_luminance
-        
-        # Convert back to RGB
-        rgb_array = yuv_to_rgb(yuv_array)
-        rgb_array = np.clip(rgb_array, 0, 255).astype(np.uint8)
-        
-        # Convert back to PIL image
-        clean_image = Image.fromarray(rgb_array, mode='RGB')
-        
-    else:
-        # Grayscale processing (original behavior)
-        if img.mode != 'L':
-            img = img.convert('L')
-
-        # Get original image dimensions
-        original_shape = (img.height, img.width)
-
-        fft_spectrum = fourier_transform_image(img)
-        clean_spectrum = attenuate_diagonal_frequencies(fft_spectrum)
-        clean_image = inverse_fourier_transform_image(clean_spectrum, is_color, original_shape)
-    
-    return clean_image
+import json
+import os
+import sys
+from functools import lru_cache
+from tempfile import mkstemp
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from PIL import Image, ImageFile
+try:
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft
+except ImportError:
+    pyfftw = None
+try:
+    import scipy.fft
+except ImportError:
+    scipy = None
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+# Tiles are filtered separately and overlap by half, see erase_rainbow_artifacts
+TILE_SIZE = 256
+TILE_HOP = TILE_SIZE // 2
+# larger pages are filtered in tiles, smaller ones with a single transform of the whole page
+FULL_FRAME_PIXELS = 3 * 1024 * 1024
+
+
+def get_cache_dir():
+    """Cache folder of the current user, nothing in it is shared with other users."""
+    if sys.platform.startswith('win'):
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.join(os.path.expanduser('~'), 'Library', 'Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'kcc')
+
+
+# FFTW plans measured by earlier conversions
+FFTW_WISDOM = os.path.join(get_cache_dir(), 'fftw-wisdom.json')
+
+
+class NumpyFFT:
+    """Single threaded transforms of NumPy, always available."""
+    name = 'numpy'
+
+    def rfft2(self, a, threads):
+        return np.fft.rfft2(a)
+
+    def irfft2(self, a, s, threads):
+        return np.fft.irfft2(a, s=s)
+
+
+class ScipyFFT:
+    """scipy.fft keeps float32 transforms in single precision and can use several threads."""
+    name = 'scipy'
+
+    def rfft2(self, a, threads):
+        return scipy.fft.rfft2(a, workers=threads, overwrite_x=True)
+
+    def irfft2(self, a, s, threads):
+        return scipy.fft.irfft2(a, s=s, workers=threads, overwrite_x=True)
+
+
+class FFTWFFT:
+    """pyFFTW with cached plans, the wisdom is saved for the next conversions."""
+    name = 'fftw'
+
+    def __init__(self):
+        pyfftw.interfaces.cache.enable()
+        pyfftw.interfaces.cache.set_keepalive_time(60)
+        self.planned = set()
+        try:
+            with open(FFTW_WISDOM, encoding='utf-8') as f:
+                pyfftw.import_wisdom(tuple(wisdom.encode() for wisdom in json.load(f)))
+        except Exception:
+            # missing or damaged, the plans are measured again
+            pass
+
+    def plan(self, key):
+        if key in self.planned:
+            return
+        self.planned.add(key)
+        temporary = None
+        try:
+            os.makedirs(os.path.dirname(FFTW_WISDOM), mode=0o700, exist_ok=True)
+            fd, temporary = mkstemp('.tmp', 'fftw-wisdom-', os.path.dirname(FFTW_WISDOM))
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump([wisdom.decode() for wisdom in pyfftw.export_wisdom()], f)
+            os.replace(temporary, FFTW_WISDOM)
+        except OSError:
+            if temporary and os.path.exists(temporary):
+                os.remove(temporary)
+
+    def rfft2(self, a, threads):
+        result = pyfftw.interfaces.numpy_fft.rfft2(a, threads=threads, planner_effort='FFTW_MEASURE')
+        self.plan(('rfft2', a.shape, threads))
+        return result
+
+    def irfft2(self, a, s, threads):
+        result = pyfftw.interfaces.numpy_fft.irfft2(a, s=s, threads=threads, planner_effort='FFTW_MEASURE')
+        self.plan(('irfft2', a.shape, threads))
+        return result
+
+
+def get_fft_backend():
+    """pyFFTW or scipy.fft when installed, NumPy otherwise."""
+    if pyfftw:
+        return FFTWFFT()
+    if scipy:
+        return ScipyFFT()
+    return NumpyFFT()
+
+
+fft_backend = get_fft_backend()
+# threads of one transform, more than one only while the worker pool has idle workers
+fft_threads = 1
+
+
+def set_fft_threads(threads):
+    global fft_threads
+    fft_threads = max(1, threads)
+
+
+def diagonal_frequency_mask(height, width, freq_threshold=0.30, target_angle=135, angle_tolerance=10):
+    """
+    Frequencies to attenuate, in the rfft2 layout of a height x width image.
+
+    Args:
+        height, width: Shape of the transformed image
+        freq_threshold: Frequency threshold in cycles/pixel (default: 0.3, theoretical max: 0.5)
+        target_angle: Target angle in degrees (default: 135)
+        angle_tolerance: Angular tolerance in degrees (default: 10)
+
+    Returns:
+        np.ndarray: Read-only boolean mask of shape (height, width // 2 + 1)
+    """
+    # Create frequency grids for rfft2 format
+    freq_y = np.fft.fftfreq(height, d=1.0).reshape(-1, 1)
+    freq_x = np.fft.rfftfreq(width, d=1.0).reshape(1, -1)
+
+    # Frequency condition, squared radial frequencies avoid sqrt
+    freq_condition = freq_x**2 + freq_y**2 >= freq_threshold**2
+
+    angles_deg = np.rad2deg(np.arctan2(freq_y, freq_x)) % 360
+
+    # Complementary angle and the perpendicular ones (135° + 45° to maximize compatibility until we know
+    # for sure which angle configure for each device)
+    angle_condition = np.zeros(angles_deg.shape, dtype=bool)
+    for angle in [target_angle, target_angle + 180, target_angle + 90, target_angle + 270]:
+        min_angle = (angle - angle_tolerance) % 360
+        max_angle = (angle + angle_tolerance) % 360
+
+        if min_angle > max_angle:  # Interval crosses 0°
+            angle_condition |= (angles_deg >= min_angle) | (angles_deg <= max_angle)
+        else:  # Normal interval
+            angle_condition |= (angles_deg >= min_angle) & (angles_deg <= max_angle)
+
+    mask = freq_condition & angle_condition
+    mask.flags.writeable = False
+    return mask
+
+
+@lru_cache(maxsize=4)
+def diagonal_frequency_gain(height, width, freq_threshold=0.30, target_angle=135, angle_tolerance=10,
+                            attenuation_factor=0.10):
+    """
+    Multiplier of every frequency in the rfft2 layout of a height x width image.
+
+    A multiplication of the whole spectrum is faster than the boolean indexing of the masked
+    frequencies, so the attenuation of a page is only the FFT/iFFT pair and this product.
+    The gains of the last few shapes are kept, the page size of the profile and the tiles
+    of larger pages.
+
+    Returns:
+        np.ndarray: Read-only float32 array, attenuation_factor where the mask is set and 1 elsewhere
+    """
+    mask = diagonal_frequency_mask(height, width, freq_threshold, target_angle, angle_tolerance)
+    gain = np.where(mask, np.float32(attenuation_factor), np.float32(1))
+    gain.flags.writeable = False
+    return gain
+
+
+def attenuate_diagonal_frequencies(fft_spectrum, freq_threshold=0.30, target_angle=135,
+                                   angle_tolerance=10, attenuation_factor=0.10):
+    """
+    Attenuates specific frequencies in the Fourier domain (rfft2 layout), in place.
+
+    Args:
+        fft_spectrum: Result of 2D real Fourier transform (from rfft2), the last two axes are transformed
+        freq_threshold: Frequency threshold in cycles/pixel (default: 0.3, theoretical max: 0.5)
+        target_angle: Target angle in degrees (default: 135)
+        angle_tolerance: Angular tolerance in degrees (default: 10)
+        attenuation_factor: Attenuation factor (0.1 = 90% attenuation)
+
+    Returns:
+        np.ndarray: Modified FFT with applied attenuation (same format as input)
+    """
+    if attenuation_factor == 1:
+        return fft_spectrum
+    height, width_rfft = fft_spectrum.shape[-2:]
+    # For rfft2, the original width is (width_rfft - 1) * 2
+    fft_spectrum *= diagonal_frequency_gain(height, (width_rfft - 1) * 2, freq_threshold, target_angle,
+                                            angle_tolerance, attenuation_factor)
+    return fft_spectrum
+
+
+@lru_cache(maxsize=1)
+def tile_window(size):
+    """
+    Separable periodic Hann window of a tile.
+
+    Shifted by half of its size the windows add up to exactly one, so the overlapping
+    filtered tiles add up to the filtered image without any normalization.
+    """
+    window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(size) / size)).astype(np.float32)
+    window = np.outer(window, window)
+    window.flags.writeable = False
+    return window
+
+
+def padded_indexes(length):
+    # mirrored edges, every pixel of the image is covered by two tiles in both directions
+    padded = -(-length // TILE_HOP) * TILE_HOP + 2 * TILE_HOP
+    return np.pad(np.arange(length), (TILE_HOP, padded - length - TILE_HOP), mode='symmetric')
+
+
+def filter_rows(band):
+    """
+    Filters one row of overlapping tiles.
+
+    Args:
+        band: float32 array of TILE_SIZE rows, its width a multiple of TILE_HOP
+
+    Returns:
+        np.ndarray: Windowed and filtered tiles added up, same shape as band
+    """
+    tiles = sliding_window_view(band, (TILE_SIZE, TILE_SIZE))[0, ::TILE_HOP] * tile_window(TILE_SIZE)
+    spectrum = attenuate_diagonal_frequencies(fft_backend.rfft2(tiles, fft_threads))
+    tiles = fft_backend.irfft2(spectrum, (TILE_SIZE, TILE_SIZE), fft_threads)
+    output = np.zeros_like(band)
+    # every other tile touches the previous one without overlap
+    for start in (0, 1):
+        part = tiles[start::2]
+        output[:, start * TILE_HOP:start * TILE_HOP + len(part) * TILE_SIZE] += \
+            part.transpose(1, 0, 2).reshape(TILE_SIZE, -1)
+    return output
+
+
+def filter_luminance(luminance, height, width):
+    """
+    Overlap-add filtering of a whole page, one row of tiles at a time.
+
+    Args:
+        luminance: Function returning the float32 luminance of the given rows and columns
+        height, width: Size of the page
+
+    Yields:
+        (first row, filtered rows): Finished rows of the page, TILE_HOP at a time
+    """
+    rows = padded_indexes(height)
+    columns = padded_indexes(width)
+    image_columns = slice(TILE_HOP, TILE_HOP + width)
+    pending = np.zeros((TILE_SIZE, len(columns)), dtype=np.float32)
+    for top in range(0, len(rows) - TILE_SIZE + 1, TILE_HOP):
+        pending += filter_rows(luminance(rows[top:top + TILE_SIZE], columns))
+        # the upper half gets nothing from the next row of tiles
+        first = top - TILE_HOP
+        if 0 <= first < height:
+            yield first, pending[:min(TILE_HOP, height - first), image_columns]
+        pending[:TILE_HOP] = pending[TILE_HOP:]
+        pending[TILE_HOP:] = 0
+
+
+def filter_full_frame(luminance, height, width):
+    """
+    Filtering of a whole page with one transform, same interface as filter_luminance.
+
+    Twice as fast as the overlapping tiles, but the memory grows with the page.
+    """
+    spectrum = fft_backend.rfft2(luminance(np.arange(height), np.arange(width)), fft_threads)
+    yield 0, fft_backend.irfft2(attenuate_diagonal_frequencies(spectrum), (height, width), fft_threads)
+
+
+def erase_rainbow_artifacts(img, is_color):
+    """
+    Remove rainbow artifacts from grayscale or color images.
+
+    Pages larger than FULL_FRAME_PIXELS are filtered in overlapping windowed tiles instead
+    of one transform of the whole page, memory use stays at a few rows of tiles whatever
+    the page size.
+
+    Args:
+        img: PIL Image (grayscale or RGB)
+        is_color: Boolean indicating if the image is to be treated as color
+
+    Returns:
+        PIL.Image: Cleaned image
+    """
+    filter_page = filter_luminance if img.width * img.height > FULL_FRAME_PIXELS else filter_full_frame
+    if is_color and img.mode in ('RGB', 'RGBA'):
+        # Convert to RGB if needed
+        if img.mode == 'RGBA':
+            img = img.convert('RGB')
+        pixels = np.asarray(img)
+        rgb_to_luminance = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+        def luminance(rows, columns):
+            return pixels[np.ix_(rows, columns)] @ rgb_to_luminance
+
+        # Only the luminance (Y of YUV) is filtered, the chrominance stays as it is.
+        # Y is the first column of YUV to RGB, a change of Y changes R, G and B the same.
+        clean = np.empty_like(pixels)
+        for first, filtered in filter_page(luminance, img.height, img.width):
+            rows = pixels[first:first + len(filtered)]
+            change = np.clip(filtered, 0, 255) - rows @ rgb_to_luminance
+            clean[first:first + len(filtered)] = np.clip(rows + change[..., None], 0, 255)
+        return Image.fromarray(clean, mode='RGB')
+
+    # Grayscale processing (original behavior)
+    if img.mode != 'L':
+        img = img.convert('L')
+    pixels = np.asarray(img)
+
+    def luminance(rows, columns):
+        return pixels[np.ix_(rows, columns)].astype(np.float32)
+
+    clean = np.empty_like(pixels)
+    for first, filtered in filter_page(luminance, img.height, img.width):
+        clean[first:first + len(filtered)] = np.clip(filtered, 0, 255)
+    return Image.fromarray(clean, mode='L')
@@ -19,15 +19,23 @@
 #
 
 import os
+from contextlib import contextmanager
 from html.parser import HTMLParser
 import subprocess
+from multiprocessing import Pool, cpu_count
 from packaging.version import Version
 from re import split
 import sys
+from threading import Condition
+from time import perf_counter
 from traceback import format_tb
 
 
 IMAGE_TYPES = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.jp2', '.avif')
+workerPool = None
+workerPoolSize = 0
+# seconds and calls per page processing stage, collected in every worker for --profile-report
+stageTimings = {}
 
 
 class HTMLStripper(HTMLParser):
@@ -87,11 +95,11 @@ def walkSort(dirnames, filenames):
     return dirnames, filenames
 
 
-def walkLevel(some_dir, level=1):
+def walkLevel(some_dir, level=1, walk=os.walk):
     some_dir = some_dir.rstrip(os.path.sep)
     assert os.path.isdir(some_dir)
     num_sep = some_dir.count(os.path.sep)
-    for root, dirs, files in os.walk(some_dir):
+    for root, dirs, files in walk(some_dir):
         dirs, files = walkSort(dirs, files)
         yield root, dirs, files
         num_sep_this = root.count(os.path.sep)
@@ -158,3 +166,88 @@ def subprocess_run(command, **kwargs):
     if (os.name == 'nt'):
         kwargs.setdefault('creationflags', subprocess.CREATE_NO_WINDOW)
     return subprocess.run(command, **kwargs)
+
+def subprocess_popen(command, **kwargs):
+    if (os.name == 'nt'):
+        kwargs.setdefault('creationflags', subprocess.CREATE_NO_WINDOW)
+    return subprocess.Popen(command, **kwargs)
+
+
+def getWorkerPool(processes=None):
+    """Worker pool shared by every stage, kept alive for the next books of the run.
+
+    processes=None reuses the running pool whatever its size, 0 means one worker per CPU.
+    """
+    global workerPool, workerPoolSize
+    if processes is None:
+        processes = workerPoolSize if workerPool else 0
+    processes = processes or cpu_count()
+    if workerPool and workerPoolSize != processes:
+        resetWorkerPool()
+    if not workerPool:
+        workerPool = Pool(processes, maxtasksperchild=100)
+        workerPoolSize = processes
+    return workerPool
+
+
+def resetWorkerPool():
+    """Stop the shared pool after a crash or an interrupted conversion, the next stage starts a fresh one."""
+    global workerPool, workerPoolSize
+    if workerPool:
+        workerPool.terminate()
+        workerPool.join()
+    workerPool = None
+    workerPoolSize = 0
+
+
+def getChunkSize(tasks):
+    # small chunks keep every worker busy until the end, a few tasks per chunk share one pickled options
+    return max(1, min(8, tasks // ((workerPoolSize or cpu_count()) * 4)))
+
+
+class MemoryBudget:
+    """Holds back pool tasks until the memory they are expected to need is free (--max-memory).
+
+    Tasks are (key, work) pairs, admit() wraps their generator and runs in the task thread of the
+    pool, release() is called with the key of every result. A task larger than the whole budget
+    still starts once nothing else is running. The tasks have to be sent with chunksize 1, a chunk
+    would wait for tasks that are held back until its own results arrive.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.running = {}
+        self.closed = False
+        self.condition = Condition()
+
+    def admit(self, tasks, estimate):
+        for task in tasks:
+            cost = estimate(task[1])
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or not self.running or self.used + cost <= self.budget)
+                if self.closed:
+                    return
+                self.running[task[0]] = cost
+                self.used += cost
+            yield task
+
+    def release(self, key):
+        with self.condition:
+            self.used -= self.running.pop(key, 0)
+            self.condition.notify_all()
+
+    def close(self):
+        # Pool.terminate() waits for the task thread, it must not be left waiting here
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+@contextmanager
+def stageTimer(stage):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        seconds, calls = stageTimings.get(stage, (0.0, 0))
+        stageTimings[stage] = (seconds + perf_counter() - start, calls + 1)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2014 Ciro Mattia Gonano <ciromattia@gmail.com>
+# Copyright (c) 2013-2019 Pawel Jastrzebski <pawelj@iosphe.re>
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all
+# copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+# WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+# DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA
+# OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+#
+
+
+import os
+from zipfile import ZipFile, ZIP_STORED
+from .shared import walkSort
+
+
+class ZipSink:
+    """Stored ZIP container (CBZ or EPUB) that is filled while pages are still being processed.
+
+    Finished pages are appended in the order they were queued, as soon as every page queued
+    before them is done. Whatever else is in the tree when the sink is closed (cover, XHTML,
+    OPF/NCX/NAV, ComicInfo.xml) follows in walk order. The container is written under a
+    temporary name and only renamed to the output name once it is complete.
+    """
+    def __init__(self, filename, basedir, store, isepub=False):
+        self.filename = os.fspath(filename)
+        self.basedir = basedir
+        self.store = store
+        self.written = set()
+        self.pending = {}
+        self.next = 0
+        self.partname = self.filename + '.part'
+        self.zip = ZipFile(self.partname, 'w', ZIP_STORED)
+        if isepub:
+            self.writestr('mimetype', 'application/epub+zip')
+
+    def writestr(self, arcname, data):
+        if arcname not in self.written:
+            self.zip.writestr(arcname, data, ZIP_STORED)
+            self.written.add(arcname)
+
+    def add(self, path):
+        arcname = os.path.relpath(path, self.basedir).replace(os.sep, '/')
+        if arcname in self.written:
+            return
+        if self.store.inmemory(path):
+            self.zip.writestr(arcname, self.store.get(path), ZIP_STORED)
+        else:
+            self.zip.write(path, arcname)
+        self.written.add(arcname)
+
+    def done(self, index, paths):
+        self.pending[index] = paths
+        while self.next in self.pending:
+            for path in sorted(self.pending.pop(self.next)):
+                self.add(path)
+            self.next += 1
+
+    def close(self):
+        for dirpath, dirnames, filenames in self.store.walk(self.basedir):
+            walkSort(dirnames, filenames)
+            for name in filenames:
+                self.add(os.path.join(dirpath, name))
+        self.zip.close()
+        os.replace(self.partname, self.filename)
+
+    def abort(self):
+        try:
+            self.zip.close()
+        except OSError:
+            pass
+        if os.path.isfile(self.partname):
+            os.remove(self.partname)